@@ -1,107 +1,89 @@
 import random
 from typing import Literal
 import streamlit as st
-from snowflake.snowpark.context import get_active_session
-from snowflake.snowpark import Session
-from snowflake.cortex import Complete
-from snowflake.core import Root
-import base64
 import io
 import bcrypt
-import json
 import pandas as pd
-from fpdf import FPDF
 
-import re
-
-from auth import login_user, register_user
+import time
+from concurrent.futures import Future
+
+from auth import SESSION_TOKEN_PARAM, login_user, logout_user, register_user, restore_user_session
+from backend import get_backend
+from retrieval import search_cache, is_self_contained, build_category_filter, chunk_id
+from cache import answer_cache
+from semantic_cache import semantic_cache
+from pipeline import answer_turn, finish_turn, start_turn
+from warmup import AnswerWarmer
+from resources import SessionPool
+from prompt_log import PromptLogWriter
+from metadata import get_categories, get_username
+from conversations import ConversationStore
+from context import estimate_tokens
+from conversation_memory import ConversationMemory
+from pdf_export import build_pdf
+from tracing import MetricsWriter, TracedSession, tracer
+from governor import BUSY_MESSAGE, governor, is_overloaded
+from config import (
+    BUTTON_TEXTS, COLUMNS, CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICES,
+    MODEL_DESCRIPTIONS, NUM_CANDIDATE_CHUNKS, NUM_CHUNKS
+)
+from routing import describe_tier, route
 
 
 
 pd.set_option("max_colwidth", None)
 
 ### Default Values
-NUM_CHUNKS = 3  
-SLIDE_WINDOW = 7  
-
-# Service parameters
-CORTEX_SEARCH_DATABASE = "CC_QUICKSTART_CORTEX_SEARCH_DOCS"
-CORTEX_SEARCH_SCHEMA = "DATA"
-CORTEX_SEARCH_SERVICE = "CC_SEARCH_SERVICE_CS"
-
-# Columns to query in the service
-COLUMNS = [
-    "chunk",
-    "relative_path",
-    "category"
-]
-
-# Full pool of potential button texts
-BUTTON_TEXTS = [
-    "What was WK Kellogg Co's revenue for 2023?",
-    "How did WK Kellogg Co compete with General Mills?",
-    "What are the top product categories in the cereal industry?",
-    "What are the health trends affecting cereal sales?",
-    "How is the cereal industry adapting to consumer preferences?",
-    "How has WK Kellogg Co's market share evolved from 2019 to 2023?",
-    "What are the key sustainability initiatives WK Kellogg Co has implemented?",
-    "What are the major trends in consumer preferences affecting cereal sales?",
-    "What are the top-performing products for General Mills in recent years?",
-    "How has the COVID-19 pandemic impacted the cereal industry?",
-    "What are the key risks facing the cereal industry?",
-    "How have health-conscious trends influenced cereal product development?",
-    "What are the major marketing strategies used by WK Kellogg Co?",
-    "How has General Mills invested in product innovation?",
-    "What are the revenue growth projections for the cereal industry through 2025?"
-]
-
-MODEL_DESCRIPTIONS = {
-    'mixtral-8x7b': "Mixtral-8x7b is an open-source transformer model, ideal for general text processing tasks such as summarization, classification, and answering questions. It performs well on medium-sized to large datasets.",
-    'snowflake-arctic': "Snowflake-Arctic is a model optimized for financial analysis and forecasting. It excels in analyzing large datasets with particular optimization for Snowflake's data lake and warehouse ecosystems.",
-    'mistral-large': "Mistral-Large is a high-performance model tailored for language generation tasks. It's great for content creation, including generating emails, reports, and marketing copy.",
-    'llama3-8b': "Llama3-8b is a powerful, general-purpose language model.It is highly optimized for maintaining coherence and structure across complex and nuanced tasks generating structured content like formal reports and conversational agents requiring adherence to format",
-    'llama3-70b': "Llama3-70b is a massive model capable of handling highly complex tasks with a deep understanding of nuanced language patterns. Ideal for advanced research or industry-specific NLP tasks.",
-    'reka-flash': "Reka-Flash is a lightweight model designed for fast inference and quick responses. It's suitable for low-latency applications like real-time chatbots or recommendation systems.",
-    'mistral-7b': "Mistral-7b is a balanced model that offers a good trade-off between performance and computational efficiency. It's useful for general NLP tasks without requiring massive compute resources.",
-    'llama2-70b-chat': "Llama2-70b-Chat is optimized for conversational AI, providing human-like dialogue capabilities. It works best in chat applications, support bots, and virtual assistants.",
-    'gemma-7b': "Gemma-7b is fine-tuned for creative tasks like writing, generating ideas, and crafting compelling stories or articles. It's ideal for content marketers and creative professionals."
-}
-
+SUMMARY_POLL_SECONDS = 1
+# Turns rendered in the chat pane; "Load earlier" pages in this many more at a time
+CHAT_WINDOW_TURNS = 10
 
 # --- Snowflake connection setup ---
 def create_snowflake_session():
+    backend = get_backend()
+    # The offline backend (KAI_BACKEND=local) needs no credentials
+    if not backend.needs_credentials:
+        return backend.create_session({})
+
     # Fetches Snowflake credentials from Streamlit secrets
     connection_parameters = {
         "account": st.secrets["snowflake"]["account"],
         "user": st.secrets["snowflake"]["user"],
         "password": st.secrets["snowflake"]["password"],
         "authenticator": st.secrets["snowflake"]["authenticator"],
-        "database": "CC_QUICKSTART_CORTEX_SEARCH_DOCS",
-        "schema": "DATA",
+        "database": CORTEX_SEARCH_DATABASE,
+        "schema": CORTEX_SEARCH_SCHEMA,
         "role": st.secrets.get("snowflake", {}).get("role", None),
         "warehouse": st.secrets.get("snowflake", {}).get("warehouse", None),
     }
     # Creates Snowpark session
-    session = Session.builder.configs(connection_parameters).create()
+    session = backend.create_session(connection_parameters)
     return session
 
-# Ensures only one session is created and used
-if 'session' not in st.session_state:
-    st.session_state['session'] = create_snowflake_session()
-session = st.session_state['session']
-
-root = Root(session)
-
-if 'root' not in st.session_state:
-    st.session_state['root'] = Root(st.session_state['session'])
-    st.session_state['svc'] = st.session_state['root'].databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
-    
-svc = st.session_state['svc']
-
-
-# Ensures the session is using the correct database and schema
-session.sql("USE DATABASE CC_QUICKSTART_CORTEX_SEARCH_DOCS").collect()
-session.sql("USE SCHEMA DATA").collect()
+# One bounded pool of sessions per process, shared by every browser tab, instead of a new
+# session per tab. Pooled sessions record every SQL statement as a tracing span.
+@st.cache_resource
+def get_session_pool():
+    return SessionPool(lambda: TracedSession(create_snowflake_session()))
+
+def create_search_services(session):
+    return get_backend().search_services(session, CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICES)
+
+# Root and the search service handles only depend on the session, so they are built once
+# per pooled session rather than on every rerun. A reconnected session has a new ID and
+# gets new handles.
+@st.cache_resource
+def get_search_services(_session, session_id):
+    return create_search_services(_session)
+
+# Every browser session sticks to one pooled session across its reruns, picked round robin
+# on its first run
+session_pool = get_session_pool()
+if 'session_pool_index' not in st.session_state:
+    st.session_state.session_pool_index = session_pool.next_index()
+session = session_pool.get_at(st.session_state.session_pool_index)
+search_services = get_search_services(session, session.session_id)
 
 ######################################################################
 # Login Related 
@@ -112,6 +94,14 @@ if 'logged_in' not in st.session_state:
 if 'show_welcome' not in st.session_state:
     st.session_state['show_welcome'] = False
 
+# The logout link carries the session token, so the user it belongs to can be logged out
+# even though the link opens a new browser session
+if st.query_params.get("logout") == "true":
+    logout_user(session)
+
+# A refreshed browser tab logs back in from its session token without checking the password again
+restore_user_session(session)
+
 # Function to display login/register interface
 def display_login_register():
     st.title("Login or Register")
@@ -152,6 +142,11 @@ def run_sql_file(session, file_path):
     except Exception as e:
         st.error(f"Error executing SQL file {file_path}: {e}")
 
+# Creates the app's tables once per process instead of on every rerun
+@st.cache_resource
+def bootstrap_schema():
+    run_sql_file(session, 'sql/login.sql')
+
 ######################################################################
 # HEADER & STYLE SHEET LOADING
 ######################################################################
@@ -167,26 +162,20 @@ def load_custom_styles():
 # Adds in our custom header with the logo, app name/title and logout button
 def add_header():
     if st.session_state['logged_in']:
-        existing_user_row = session.sql(f"SELECT username FROM users WHERE id = '{st.session_state.get('user_id')}'").collect()
-        existing_user = existing_user_row[0]['USERNAME'] 
+        existing_user = st.session_state.get('username') or get_username(session, st.session_state.get('user_id'))
 
-        username = st.session_state.get('user_id', 'User')
+        logout_link = f"?logout=true&{SESSION_TOKEN_PARAM}={st.query_params.get(SESSION_TOKEN_PARAM, '')}"
         st.markdown(
             f"""
             <div class='fixed-header'>
             <img src='https://i.ytimg.com/vi/X13SUD8iD-8/maxresdefault.jpg' alt='WK Kellogg Co Logo'>
             <h2 id='ask-kai'>Ask KAI!</h2>
             <p id='username-display'>Logged in as {existing_user}</p>
-            <a href="?logout=true" target="_self" id="logout_button">Logout</a>
+            <a href="{logout_link}" target="_self" id="logout_button">Logout</a>
             </div>
             """,
             unsafe_allow_html=True
         )
-
-        if st.query_params.get("logout") == "true":
-            st.session_state['logged_in'] = False
-            st.query_params.from_dict({})  
-            st.rerun()
     else:
         st.markdown(
             """
@@ -202,110 +191,79 @@ def add_header():
 # NOTE TAKING FUNCTIONS & EXPORTING NOTES, SUMMARY, AND CHAT TO PDF
 ######################################################################
 
-# Adds in a text area for users to write notes and a button to save them
+# Adds in a text area for users to write notes and a button to save them. The sidebar
+# sections are fragments, so their buttons only rerun their own section.
+@st.fragment
 def notes_section():
-    st.sidebar.markdown("## 📝 Note-Taking")
+    st.markdown("## 📝 Note-Taking")
     
     if "notes" not in st.session_state:
         st.session_state.notes = []
 
-    new_note = st.sidebar.text_area("Add a new note:", key="note_input")
+    new_note = st.text_area("Add a new note:", key="note_input")
     
-    if st.sidebar.button("Save Note"):
+    if st.button("Save Note"):
         if new_note:
             st.session_state.notes.append(new_note)
-            st.sidebar.success("Note saved!")
+            st.success("Note saved!")
         else:
-            st.sidebar.warning("Please enter a note before saving.")
+            st.warning("Please enter a note before saving.")
     
-    if st.sidebar.button("Export Notes as PDF"):
+    if st.button("Export Notes as PDF"):
         if st.session_state.notes:
             export_notes_to_pdf()
         else:
-            st.sidebar.warning("No notes to export.")
-
-# Handles exporting any note the user saved to a PDF
-def export_notes_to_pdf():
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-
-    pdf.cell(200, 10, txt="Saved Notes", ln=True, align="C")
-    pdf.ln(10)  
+            st.warning("No notes to export.")
 
-    for idx, note in enumerate(st.session_state.notes, start=1):
-        pdf.multi_cell(0, 10, f"Note {idx}:\n{note}")
-        pdf.ln(5)  
+# Offers an in-memory PDF for download. The file is served by Streamlit's media endpoint
+# when the user clicks the button instead of being inlined into the page as base64.
+def offer_pdf_download(sections, file_name, label):
+    st.download_button(label, data=build_pdf(sections), file_name=file_name, mime="application/pdf")
 
-    pdf_file = "/tmp/notes.pdf"
-    pdf.output(pdf_file)
+def notes_paragraphs():
+    return [f"Note {idx}:\n{note}" for idx, note in enumerate(st.session_state.notes, start=1)]
 
-    with open(pdf_file, "rb") as file:
-        b64_pdf = base64.b64encode(file.read()).decode("utf-8")
-        href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="notes.pdf">Download Notes as PDF</a>'
-        st.sidebar.markdown(href, unsafe_allow_html=True)
+# Handles exporting any note the user saved to a PDF
+def export_notes_to_pdf():
+    offer_pdf_download([("Saved Notes", notes_paragraphs())], "notes.pdf", "Download Notes as PDF")
 
 # Handles export of the summarized response to a PDF
 def export_summary_to_pdf(summary):
     if not summary:
-        st.sidebar.warning("No summary available to export.")
+        st.warning("No summary available to export.")
         return
-    
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-
-    pdf.cell(200, 10, txt="Response Summary", ln=True, align="C")
-    pdf.ln(10)  
-
-    pdf.multi_cell(0, 10, summary)
-    pdf.ln(2)  
 
-    pdf_file = "/tmp/response_summary.pdf"
-    pdf.output(pdf_file)
-
-    with open(pdf_file, "rb") as file:
-        b64_pdf = base64.b64encode(file.read()).decode("utf-8")
-        href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="response_summary.pdf">Download Response Summary as PDF</a>'
-        st.sidebar.markdown(href, unsafe_allow_html=True)
+    offer_pdf_download([("Response Summary", [summary])], "response_summary.pdf", "Download Response Summary as PDF")
 
 # Handles export of the active chat to a PDF 
 def export_chat_to_pdf():
     if "messages" not in st.session_state or not st.session_state.messages:
-        st.sidebar.warning("No chat messages to export.")
+        st.warning("No chat messages to export.")
         return
 
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-
-    pdf.cell(200, 10, txt="Chat Conversation", ln=True, align="C")
-    pdf.ln(10)  
-
+    messages = []
     for message in st.session_state.messages:
         role = "User" if message["role"] == "user" else "Assistant"
-        pdf.multi_cell(0, 10, f"{role}: {message['content']}")
-        pdf.ln(2)  
+        messages.append(f"{role}: {message['content']}")
+    sections = [("Chat Conversation", messages)]
 
     if "notes" in st.session_state and st.session_state.notes:
-        pdf.add_page()  
-        pdf.cell(200, 10, txt="Saved Notes", ln=True, align="C")
-        pdf.ln(10)  
+        sections.append(("Saved Notes", notes_paragraphs()))
 
-        for idx, note in enumerate(st.session_state.notes, start=1):
-            pdf.multi_cell(0, 10, f"Note {idx}: {note}")
-            pdf.ln(2)  
+    offer_pdf_download(sections, "chat_conversation.pdf", "Download Chat as PDF")
 
-    pdf_file = "/tmp/chat_conversation.pdf"
-    pdf.output(pdf_file)
+@st.fragment
+def export_section():
+    st.markdown("## Export Chat")
+    if st.button("Export Chat as PDF"):
+        export_chat_to_pdf()
 
-    with open(pdf_file, "rb") as file:
-        b64_pdf = base64.b64encode(file.read()).decode("utf-8")
-        href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="chat_conversation.pdf">Download Chat as PDF</a>'
-        st.sidebar.markdown(href, unsafe_allow_html=True)
+    st.markdown("## Export Summary")
+    if st.button("Export Summary as PDF"):
+        if "summary" in st.session_state and st.session_state.summary:
+            export_summary_to_pdf(resolve_summary(st.session_state.summary))
+        else:
+            st.warning("Generate a response summary first before exporting.")
 
 
 
@@ -315,191 +273,160 @@ def display_model_documentation():
     st.markdown("## 📚 Model Documentation")
     st.markdown("Here are the models available for selection and their descriptions:")
     
-    for model, description in MODEL_DESCRIPTIONS.items():
+    for model, details in MODEL_DESCRIPTIONS.items():
         st.markdown(f"### **{model}**")
-        st.write(description)
+        st.caption(describe_tier(model))
+        st.write(details['description'])
         st.markdown("---")  
 
+@st.fragment
 def config_options():
     # Sidebar dropdown for model selection
-    selected_model = st.sidebar.selectbox(
+    selected_model = st.selectbox(
         'Select your model:', 
         list(MODEL_DESCRIPTIONS.keys()), 
         key="model_name"
     )
 
     # Automatically display the description of the selected model
-    st.sidebar.markdown(f"### Selected Model: **{selected_model}**")
-    st.sidebar.write(MODEL_DESCRIPTIONS[selected_model])
-
-    categories = session.table('docs_chunks_table').select('category').distinct().collect()
-    cat_list = ['ALL'] + [cat.CATEGORY for cat in categories]
-    st.sidebar.checkbox('Remember chat history?', key="use_chat_history", value=True)
-    st.sidebar.button("Start Over", key="clear_conversation", on_click=start_over)
-
-    if st.session_state.get('logged_in'):
-        user_id = st.session_state.get('user_id')
-        if user_id:
-            past_prompts_df = session.table('user_prompts') \
-                .filter(f"user_id = {user_id}") \
-                .select('prompt_text', 'id') \
-                .order_by('id', ascending=False) \
-                .limit(20) \
-                .collect()
-            past_prompts = [row['PROMPT_TEXT'][:100] for row in past_prompts_df]
-
-            if 'past_chats_selectbox' not in st.session_state:
-                st.session_state['past_chats_selectbox'] = 'Select a prompt'
-
-            if 'last_processed_prompt' not in st.session_state:
-                st.session_state['last_processed_prompt'] = None
-
-            if past_prompts:
-                selected_past_prompt = st.sidebar.selectbox(
-                    'Past Chats',
-                    ['Select a prompt'] + past_prompts,
-                    key='past_chats_selectbox'
-                )
-                if (selected_past_prompt and selected_past_prompt != 'Select a prompt' and
-                    selected_past_prompt != st.session_state['last_processed_prompt']):
-                    st.session_state.messages.append({"role": "user", "content": selected_past_prompt})
-                    answer, summary, _ = answer_question(selected_past_prompt)
-                    with st.chat_message("user"):
-                        st.markdown(selected_past_prompt)
-                    with st.chat_message("assistant"):
-                        st.markdown(answer)
-                    st.session_state.messages.append({"role": "assistant", "content": answer})
-                    st.session_state.summary = summary
-                    st.session_state.show_recommendations = False
-                    st.session_state['last_processed_prompt'] = selected_past_prompt
-
-                    st.rerun()
-
+    st.markdown(f"### Selected Model: **{selected_model}**")
+    st.caption(describe_tier(selected_model))
+    st.write(MODEL_DESCRIPTIONS[selected_model]['description'])
+    st.caption(f"Query rewrites and summaries run on {route('summary', selected_model)[0]}.")
+
+    # Leaving the selection empty searches all categories
+    st.multiselect('Filter by category:', get_categories(session), key="selected_categories", placeholder='ALL')
+    st.checkbox('Remember chat history?', key="use_chat_history", value=True)
+    st.checkbox('Stream responses?', key="stream_responses", value=True)
+    # Clearing the chat needs the whole page, not just this fragment
+    if st.button("Start Over", key="clear_conversation", on_click=start_over):
+        st.rerun()
+
+# Latency per pipeline stage (p50/p95 over recent spans, process-wide), the breakdown of the
+# last turn, Cortex slots and queues, cache hit rates and the size of the conversation memory
+@st.fragment
+def diagnostics_panel():
+    st.button("Refresh", key="refresh_diagnostics")
+    stage_stats = tracer.stats()
+    if stage_stats:
+        st.write("Latency per stage")
+        st.dataframe(pd.DataFrame.from_dict(stage_stats, orient="index"))
+
+    last_trace_id = st.session_state.get("last_trace_id")
+    if last_trace_id:
+        spans = tracer.spans_for(last_trace_id)
+        if spans:
+            st.write("Last turn")
+            st.dataframe(pd.DataFrame([span.as_dict() for span in spans]))
+
+    governor_stats = governor.stats()
+    if governor_stats:
+        st.write("Cortex calls")
+        st.dataframe(pd.DataFrame.from_dict(governor_stats, orient="index"))
+
+    if "prompt_tokens" in st.session_state:
+        st.write(f"Last prompt: ~{st.session_state.prompt_tokens} tokens")
+    st.write("Search results", search_cache.stats())
+    st.write("Answers", answer_cache.memory.stats())
+    st.write("Similar questions", semantic_cache.stats())
+    st.write("Conversation memory", get_conversation_memory().stats())
+
+# Lists the user's stored turns, newest first, with a button to page in older ones.
+# Selecting a turn replays the stored question and answer without generating it again.
+@st.fragment
+def past_chats_panel(user_id):
+    store = get_conversation_store()
+    # The newest page comes from the store's cache, which is refreshed whenever a turn is saved.
+    # Older pages are only loaded on request and kept for the browser session.
+    if st.session_state.get('older_turns_user') != user_id:
+        st.session_state['older_turns'] = []
+        st.session_state['older_turns_has_more'] = None
+        st.session_state['older_turns_user'] = user_id
+    first_page = store.list_turns(session, user_id)
+    past_turns = first_page.turns + st.session_state['older_turns']
+    has_more = first_page.has_more
+    if st.session_state['older_turns_has_more'] is not None:
+        has_more = st.session_state['older_turns_has_more']
+    questions = {turn.id: turn.question for turn in past_turns}
+
+    if 'past_chats_selectbox' not in st.session_state:
+        st.session_state['past_chats_selectbox'] = 'Select a prompt'
+
+    if 'last_processed_prompt' not in st.session_state:
+        st.session_state['last_processed_prompt'] = None
+
+    if not past_turns:
+        return
 
+    selected_turn_id = st.selectbox(
+        'Past Chats',
+        ['Select a prompt'] + list(questions),
+        format_func=lambda option: questions[option][:100] if option in questions else option,
+        key='past_chats_selectbox'
+    )
+    if has_more and st.button("Load older chats"):
+        older_page = store.list_turns(session, user_id, before_id=past_turns[-1].id)
+        st.session_state['older_turns'] += older_page.turns
+        st.session_state['older_turns_has_more'] = older_page.has_more
+        st.rerun(scope="fragment")
+
+    if (selected_turn_id != 'Select a prompt' and
+        selected_turn_id != st.session_state['last_processed_prompt']):
+        turn = store.get_turn(session, user_id, selected_turn_id)
+        if turn is None:
+            st.warning("This chat is no longer available.")
+            return
+        st.session_state.messages.append({"role": "user", "content": turn.question})
+        st.session_state.messages.append({"role": "assistant", "content": turn.answer, "summary": turn.summary})
+        get_conversation_memory().add_turn(session, st.session_state.model_name, turn.question, turn.answer)
+        st.session_state.summary = turn.summary
+        st.session_state.show_recommendations = False
+        st.session_state['last_processed_prompt'] = selected_turn_id
+
+        # The replayed turn is shown by the chat pane, which is outside this fragment
+        st.rerun()
 
 def init_messages():
-    if st.session_state.clear_conversation or "messages" not in st.session_state:
+    if st.session_state.get('clear_conversation') or "messages" not in st.session_state:
         st.session_state.messages = []
         st.session_state.show_welcome_message = True
     else:
         st.session_state.show_welcome_message = False
 
-svc_file_1 = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
-svc_file_2 = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
-
-# Retrieves "similar" chunks, meaning chunks (data) that are related to the query
-def get_similar_chunks_search_service(query):
-    response_file_1 = svc_file_1.search(query, COLUMNS, limit=NUM_CHUNKS)
-    response_file_2 = svc_file_2.search(query, COLUMNS, limit=NUM_CHUNKS)
-    try:
-        json_response_1 = json.loads(response_file_1.json())  
-        json_response_2 = json.loads(response_file_2.json())  
-    except Exception as e:
-        st.error(f"Failed to parse JSON response: {e}")
-        return {}
-    results_1 = json_response_1.get('results', [])
-    results_2 = json_response_2.get('results', [])
-    combined_response = {
-        "results": results_1 + results_2
-    }
-    st.sidebar.json(combined_response)
-    return json.dumps(combined_response)
-
-
-# Summarize chat history with the current question
-def summarize_question_with_history(chat_history, question):
-    prompt = f"""
-        Based on the chat history below and the question, generate a query that extends the question
-        with the chat history provided. The query should be in natural language. 
-        Answer with only the query.
-<chat_history>{chat_history}</chat_history>
-<question>{question}</question>
-"""    
-    summary = Complete(st.session_state.model_name, prompt, session=session)
-    return summary.replace("'", "")
-
-def create_prompt(myquestion):
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
-        if chat_history:
-            question_summary = summarize_question_with_history(chat_history, myquestion)
-            response_file_1 = svc_file_1.search(question_summary, COLUMNS, limit=NUM_CHUNKS)
-            response_file_2 = svc_file_2.search(question_summary, COLUMNS, limit=NUM_CHUNKS)
-        else:
-            response_file_1 = svc_file_1.search(myquestion, COLUMNS, limit=NUM_CHUNKS)
-            response_file_2 = svc_file_2.search(myquestion, COLUMNS, limit=NUM_CHUNKS)
-    else:
-        response_file_1 = svc_file_1.search(myquestion, COLUMNS, limit=NUM_CHUNKS)
-        response_file_2 = svc_file_2.search(myquestion, COLUMNS, limit=NUM_CHUNKS)
-
-    try:
-        prompt_context_1 = json.loads(response_file_1.json()).get('results', [])
-        prompt_context_2 = json.loads(response_file_2.json()).get('results', [])
-
-    except Exception as e:
-        st.error(f"Error parsing search response JSON: {e}")
-        prompt_context_1 = []
-        prompt_context_2 = []
- 
-    prompt = prompt = f""" 
-        As an expert financial analyst, provide a detailed analysis of the financial statements (10Q, 10K) of WK Kellogg Co and General Mills from 2019-2024. Focus on these aspects:
-        1. Revenue Trends (Provide a table)- Talk about the sales figures, the products sold and the countries/regions the products are sold in
-        2. Net Income 
-        3. Cash Flow Analysis 
-        4. Areas of Investments made by the company (Provide a table)
-        5. Efficiency and Cost Control Strategies: Analyze how WK Kellogg Co and General Mills is working to improve operational efficiency and reduce marginal costs.
-        6. Profit Margins: Break down gross, operating, and net profit margins (Display in a table).
-        7. Key Risk Factors 
-        8. Cereal/product prices 
-        9. Exactly which product(s) example froot loops or cornflakes generated most revenue?
-    
-        
-    
-         **Important**: Even if specific data is not available, leverage pre-trained financial knowledge to provide the most accurate analysis possible based on typical industry standards and practices. Do not state that you lack the context; instead, offer insights and trends based on relevant industry data.  
-         **Important**:Do not cover all aspects at once; address them only when specifically requested.
-         **Important**:Anytime the user enters the word "We" or 'we' or 'WE' it is referring to WK Kellogg Co as you are part of their financial department.
-         Answer:
-         <context 1>{prompt_context_1}</context 1>
-         <context 2>{prompt_context_2}</context 2>
-         <question>{myquestion}</question>
-         Answer:
-
-
-    
-#         Also, As a financial analyst specialized in the cereal and consumer packaged goods (CPG) industries, provide a direct, data-driven answer to the question based only on the specific area requested. Use financial insights from available SEC filings, historical financial data (10Q, 10K), and industry knowledge, but keep responses brief and focused. 
-        
-#         Important Details to Include in Responses:
-#         1. Only address the requested topic (e.g., supply/demand changes, M&A activities, investment programs, etc.) with concise, quantified data or insights where applicable.
-#         2. If relevant, summarize tables of revenue, investment, or margin metrics with recent trends rather than providing full tables unless explicitly requested.
-        3. For questions about competitors, draw insights from publicly available filings, such as investment initiatives, market expansion, product shifts, or financial strategies.
-        4. If industry-wide trends or macroeconomic impacts are requested, focus on significant changes, shareholder response, or sector-wide risks.
-        
-        **Guidelines**:
-        - Even if specific data is not available, leverage pre-trained financial knowledge to provide the most accurate analysis possible based on typical industry standards and practices. Do not state that you lack the context; instead, offer insights and trends based on relevant industry data. 
-        - Use context from past SEC filings, public stock data, and known macroeconomic impacts to suggest trends where specific figures may not be available.
-        - Assume "We" refers to WK Kellogg Co.
-        - When responding, ensure that numbers and units (e.g., '3,515 million') have proper spacing to avoid unintended styling. Do not use underscores or other characters directly following numeric values.
-        
-        Question:
-        {myquestion}
-        
-        Context:
-        <context 1>{prompt_context_1}</context 1>
-        <context 2>{prompt_context_2}</context 2>
-        
-        Answer:
-        """
-    return prompt, [prompt_context_1, prompt_context_2]
-
-
-
-def save_prompt_to_database(session, user_id, prompt_text):
-    if user_id is None or not prompt_text:
-        raise ValueError("User ID and prompt text must not be NULL or empty")
-
-    sql_query = f"INSERT INTO user_prompts (user_id, prompt_text) VALUES ('{user_id}', '{prompt_text}')"
+# Starts the background job that pre-computes answers for every recommendation and model.
+# cache_resource makes sure it is only started once per process, not on every rerun.
+@st.cache_resource
+def start_answer_warmer():
+    warmer = AnswerWarmer(session_pool, create_search_services, COLUMNS, NUM_CANDIDATE_CHUNKS, NUM_CHUNKS, BUTTON_TEXTS, MODEL_DESCRIPTIONS.keys())
+    warmer.start()
+    return warmer
+
+# Prompt logging goes through one background writer per process, which batches the inserts
+@st.cache_resource
+def get_prompt_log_writer():
+    return PromptLogWriter(session_pool)
+
+@st.cache_resource
+def get_conversation_store():
+    return ConversationStore(session_pool)
+
+# Tracing spans are written to pipeline_metrics by one background writer per process
+@st.cache_resource
+def start_metrics_writer():
+    tracer.writer = MetricsWriter(session_pool)
+    return tracer.writer
+
+# Stores the answered turn so it can be replayed from "Past Chats"
+def record_turn(question, answer, summary, prompt_context):
+    user_id = st.session_state.get('user_id')
+    if not user_id:
+        return
+    chunk_ids = [chunk_id(result) for result in prompt_context]
+    get_conversation_store().save_turn(user_id, question, answer, summary, chunk_ids, st.session_state.model_name)
 
-    session.sql(sql_query).collect()  
+# Queues the prompt together with its answer, model and latency for the log writer
+def save_prompt_to_database(user_id, prompt_text, answer, latency_ms):
+    get_prompt_log_writer().log(user_id, prompt_text, answer, st.session_state.model_name, latency_ms)
 
 def display_welcome_message():
     st.markdown(
@@ -512,50 +439,213 @@ def display_welcome_message():
         unsafe_allow_html=True
     )
 
-def clean_response(response):
-    
-    response = re.sub(r'(\d)(million|billion)', r'\1 million', response)
-    response = re.sub(r'(\d)(thousand)', r'\1 thousand', response)
-    return response
+# Answers the prompt using the model. With stream=True the answer is written into an
+# assistant chat message token by token instead of appearing all at once at the end.
+# Answers are cached by model, normalized question and the chunks retrieved for it, so a
+# repeated question skips both Complete calls. Rephrasings of an earlier question are found
+# in the semantic cache before retrieval and skip the whole RAG pass.
+# Every turn is traced; its spans are listed in the Diagnostics panel.
+def answer_question(myquestion, stream=False):
+    model_name = st.session_state.model_name
+    with tracer.trace("turn", model_name, myquestion) as span:
+        st.session_state.last_trace_id = span.trace_id
+        cleaned_response, summary, relative_paths = generate_response(myquestion, model_name, stream)
+        span.set_response(cleaned_response)
+    return cleaned_response, summary, relative_paths
 
-def summarize_response(response):
-    prompt = f"""
-    Provide a concise summary of the following response, focusing on the top three key insights only. Organize the summary in three clear, actionable bullet points:
+# The turn itself runs in pipeline (start_turn, answer_turn, finish_turn); this adds the chat
+# memory, the selected categories and the rendering. The conversation memory is only used (and
+# the rewrite only paid for) when the question is not self-contained. Selected categories are
+# pushed down to the search service as a filter.
+def generate_response(myquestion, model_name, stream):
+    conversation = ""
+    if st.session_state.use_chat_history and not is_self_contained(myquestion):
+        conversation = get_conversation_memory().context()
+    search_filter = build_category_filter(st.session_state.get('selected_categories'))
+
+    turn = start_turn(
+        session, model_name, search_services, myquestion, conversation, COLUMNS, NUM_CANDIDATE_CHUNKS, NUM_CHUNKS,
+        search_filter
+    )
+    if turn.search_error is not None:
+        st.error(f"Error parsing search response JSON: {turn.search_error}")
+    if turn.prompt:
+        st.session_state.prompt_tokens = estimate_tokens(turn.prompt)
 
-    {response}
+    if turn.cached:
+        if stream:
+            with st.chat_message("assistant"):
+                st.markdown(turn.answer)
+        return turn.answer, turn.summary, turn.prompt_context
 
-    Key Insights (Limit to 3):
-    """
-    summary = Complete(st.session_state.model_name, prompt, session=session)
+    if stream:
+        with st.chat_message("assistant"):
+            cleaned_response = st.write_stream(answer_turn(session, turn, stream=True))
+            show_fallback_notice(model_name, turn.routing.model_name)
+    else:
+        cleaned_response = answer_turn(session, turn)
+        st.session_state.answered_by = turn.routing.model_name
+
+    # The summary is only needed by the sidebar and the PDF export, so it is generated after
+    # the answer is returned and the returned summary is a Future until then
+    summary = finish_turn(session, turn, cleaned_response)
+    return cleaned_response, summary, turn.prompt_context
+
+# Tells the user when the selected model was unavailable and another one answered
+def show_fallback_notice(model_name, answered_by):
+    if answered_by and answered_by != model_name:
+        st.caption(f"{model_name} was unavailable, so {answered_by} answered.")
+
+# Returns the summary text, waiting for it first if it is still being generated
+def resolve_summary(summary):
+    if isinstance(summary, Future):
+        try:
+            return summary.result()
+        except Exception as e:
+            st.error(f"Error summarizing response: {e}")
+            return None
     return summary
 
+def summary_pending():
+    summary = st.session_state.get("summary")
+    return isinstance(summary, Future) and not summary.done()
+
+# Shows the latest response summary in the sidebar. It is redrawn by the full rerun that
+# summary_watcher starts once a new summary is ready.
+@st.fragment
+def response_summary_panel():
+    st.markdown("## 📄 Response Summary")
+    summary = st.session_state.get("summary")
+    if summary_pending():
+        st.caption("Summarizing response...")
+    elif summary is not None:
+        st.write(resolve_summary(summary))
+
+# Only drawn by the chat pane while the latest summary is being generated, so nothing polls
+# once it is done. The sidebar cannot be redrawn from the chat fragment, so a full rerun
+# brings the finished summary there.
+@st.fragment(run_every=SUMMARY_POLL_SECONDS)
+def summary_watcher():
+    if summary_pending():
+        st.caption("Summarizing response...")
+    else:
+        st.rerun()
 
-# Answers the prompt using the model
-def answer_question(myquestion):
-    prompt, relative_paths = create_prompt(myquestion)
-    response = Complete(st.session_state.model_name, prompt, session=session) 
-    cleaned_response = clean_response(response)
-    summary = summarize_response(cleaned_response)
-    st.text(cleaned_response)
-    return cleaned_response, summary, relative_paths
-
-# Gets chat history from the last 7 messages (the slide window size) to use for context
-def get_chat_history():
-    chat_history = []
-    start_index = max(0, len(st.session_state.messages) - SLIDE_WINDOW)
-    chat_history.extend(st.session_state.messages[start_index:])
-    return chat_history
+# Compact memory of the conversation for the query rewrite, kept for the browser session
+def get_conversation_memory():
+    if 'conversation_memory' not in st.session_state:
+        st.session_state.conversation_memory = ConversationMemory()
+    return st.session_state.conversation_memory
     
 # Resets the chat, reccomendations, selected prompt from history, and reruns the app
 def start_over():
     st.session_state.show_recommendations = True
     st.session_state.messages = [] 
+    st.session_state.conversation_memory = ConversationMemory()
     st.session_state.visible_recommendations = random.sample(BUTTON_TEXTS, 3) 
     st.session_state["reset_requested"] = True  
     st.session_state['last_processed_prompt'] = None
+    st.session_state.chat_window_turns = CHAT_WINDOW_TURNS
     st.rerun()
 
 
+def render_message(message):
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+
+# Renders the turns that existed at the last full run, newest CHAT_WINDOW_TURNS first. Older
+# turns are only rendered once the user pages them in, which reruns just this fragment.
+@st.fragment
+def chat_history_pane():
+    messages = st.session_state.messages[:st.session_state.rendered_messages]
+    window_turns = st.session_state.setdefault('chat_window_turns', CHAT_WINDOW_TURNS)
+    start_index = max(0, len(messages) - 2 * window_turns)
+    if start_index and st.button(f"Load earlier messages ({start_index} more)", key="load_earlier_messages"):
+        st.session_state.chat_window_turns = window_turns + CHAT_WINDOW_TURNS
+        st.rerun(scope="fragment")
+    for message in messages[start_index:]:
+        render_message(message)
+
+# Runs a turn for a question from the chat box or a recommendation and stores it
+def run_turn(question):
+    with st.chat_message("user"):
+        st.markdown(question)
+
+    started_at = time.perf_counter()
+    st.session_state.answered_by = None
+    # Under load Cortex calls are queued, retried and finally shed. A turn that fails gets a
+    # busy notice or a short error instead of a stack trace, and nothing about it is stored,
+    # not even the question in the chat history.
+    try:
+        answer, summary, prompt_context = answer_question(question, stream=st.session_state.stream_responses)
+    except Exception as e:
+        if is_overloaded(e):
+            st.warning(BUSY_MESSAGE)
+        else:
+            st.error(f"Could not answer the question: {e}")
+        return
+    if not st.session_state.stream_responses:
+        with st.chat_message("assistant"):
+            st.markdown(answer)
+            show_fallback_notice(st.session_state.model_name, st.session_state.answered_by)
+
+    # Save prompt to database
+    user_id = st.session_state.get('user_id')
+    if user_id:
+        save_prompt_to_database(user_id, question, answer, int((time.perf_counter() - started_at) * 1000))
+    record_turn(question, answer, summary, prompt_context)
+    get_conversation_memory().add_turn(session, st.session_state.model_name, question, answer)
+
+    st.session_state.messages.append({"role": "user", "content": question})
+    st.session_state.messages.append({"role": "assistant", "content": answer, "summary": summary})
+    st.session_state.summary = summary
+
+# Welcome message, recommendations, the turns added since the last full run and the chat box.
+# Asking a question only reruns this fragment, so just the turns since the last full run are
+# rendered instead of the whole script and every earlier message. A full rerun follows once
+# the turn's summary is ready (see summary_watcher).
+@st.fragment
+def chat_pane():
+    # Display welcome message and recommendations if no conversation has started and recommendations are active
+    if st.session_state.show_recommendations and not st.session_state.messages:
+        display_welcome_message()
+
+    # Display the three selected recommendations
+    if st.session_state.show_recommendations:
+        # Placeholder above the buttons so a streamed answer is not rendered inside a column
+        recommendation_chat = st.container()
+        cols = st.columns(3)
+        for i, rec in enumerate(st.session_state.visible_recommendations):
+            with cols[i]:
+                if st.button(rec, key=f"recommendation_{i}"):
+                    st.session_state.selected_recommendation = rec
+                    with recommendation_chat:
+                        run_turn(rec)
+                    st.session_state.show_recommendations = False
+                    # Redraws the fragment without the recommendations
+                    st.rerun(scope="fragment")
+
+    for message in st.session_state.messages[st.session_state.rendered_messages:]:
+        render_message(message)
+
+    # Handling user input from chat box
+    if prompt := st.chat_input("Ask a question:"):
+        recommendations_shown = st.session_state.show_recommendations
+        run_turn(prompt)
+
+        # Hides the recommendations after a user submits a prompt
+        st.session_state.show_recommendations = False
+        if recommendations_shown:
+            st.rerun(scope="fragment")
+        # Once a window's worth of turns has piled up here they are handed over to the
+        # windowed history pane, so this fragment never redraws more than that
+        if len(st.session_state.messages) - st.session_state.rendered_messages >= 2 * CHAT_WINDOW_TURNS:
+            st.rerun()
+
+    if summary_pending():
+        summary_watcher()
+
+
 def main():
     if st.session_state['logged_in']:
         # Checks for reset flag in session state
@@ -564,23 +654,18 @@ def main():
             st.session_state['past_chats_selectbox'] = 'Select a prompt'
             st.rerun()
 
-        config_options()
         init_messages()
-        notes_section()
-
-        st.sidebar.markdown("## Export Chat")
-        if st.sidebar.button("Export Chat as PDF"):
-            export_chat_to_pdf()
-
-        st.sidebar.markdown("## Export Summary")
-        if st.sidebar.button("Export Summary as PDF"):
-            if "summary" in st.session_state and st.session_state.summary:
-                export_summary_to_pdf(st.session_state.summary)
-            else:
-                st.sidebar.warning("Generate a response summary first before exporting.")
-
-
 
+        with st.sidebar:
+            config_options()
+            with st.expander("Diagnostics"):
+                diagnostics_panel()
+            user_id = st.session_state.get('user_id')
+            if user_id:
+                past_chats_panel(user_id)
+            notes_section()
+            export_section()
+            response_summary_panel()
 
         # Show recommendations only when the page is first loaded or when "Start Over" is clicked
         if 'show_recommendations' not in st.session_state:
@@ -590,60 +675,16 @@ def main():
         if 'selected_recommendation' not in st.session_state:
             st.session_state.selected_recommendation = None
 
-        # Display welcome message and recommendations if no conversation has started and recommendations are active
-        if st.session_state.show_recommendations and not st.session_state.messages:
-            display_welcome_message()
-
         if 'visible_recommendations' not in st.session_state:
             st.session_state.visible_recommendations = random.sample(BUTTON_TEXTS, 3)
 
-        # Display the three selected recommendations
-        if st.session_state.show_recommendations:
-            cols = st.columns(3)
-            for i, rec in enumerate(st.session_state.visible_recommendations):
-                with cols[i]:
-                    if st.button(rec, key=f"recommendation_{i}"):
-                        st.session_state.selected_recommendation = rec
-                        st.session_state.messages.append({"role": "user", "content": rec})
-                        answer, summary, _ = answer_question(rec)
-                        st.session_state.messages.append({"role": "assistant", "content": answer})
-                        st.session_state.summary = summary
-                        st.session_state.show_recommendations = False
-                        st.rerun()
+        # Messages up to here are rendered by the history pane, later ones by the chat pane
+        st.session_state.rendered_messages = len(st.session_state.messages)
 
         # If recommendations have been clicked, display conversation history
-        if not st.session_state.show_recommendations and st.session_state.past_chats_selectbox == 'Select a prompt':
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
-
-        # Handling user input from chat box
-        if prompt := st.chat_input("Ask a question:"):
-            st.session_state.messages.append({"role": "user", "content": prompt})
-
-            # Save prompt to database
-            user_id = st.session_state.get('user_id')
-            if user_id:
-                save_prompt_to_database(session, user_id, prompt)
-
-            answer, summary, _ = answer_question(prompt)
-
-            with st.chat_message("user"):
-                st.markdown(prompt)
-
-            with st.chat_message("assistant"):
-                st.markdown(answer)
-
-            st.session_state.messages.append({"role": "assistant", "content": answer})
-            st.session_state.summary = summary
-
-            # Hides the recommendations after a user submits a prompt
-            st.session_state.show_recommendations = False
-            st.rerun()
-
-        st.sidebar.markdown("## 📄 Response Summary")
-        if "summary" in st.session_state:
-            st.sidebar.write(st.session_state.summary)
+        if not st.session_state.show_recommendations:
+            chat_history_pane()
+        chat_pane()
 
         # Reset recommendations when "Start Over" button is clicked
         if st.button("Start Over"):
@@ -656,5 +697,7 @@ def main():
 if __name__ == "__main__":
     load_custom_styles()
     add_header()
-    run_sql_file(session, 'sql/login.sql')
+    bootstrap_schema()
+    start_metrics_writer()
+    start_answer_warmer()
     main()
\ No newline at end of file
@@ -1,7 +1,41 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+
 import bcrypt
 import streamlit as st
 import re
 
+from lru import LRUCache
+
+
+# A login is remembered in a signed token in the URL, so a browser refresh restores it without
+# another bcrypt check. Tokens carry the user's token_version; logging out bumps it, which
+# revokes every token issued to the user before, including copied URLs.
+SESSION_TOKEN_PARAM = "session"
+SESSION_TOKEN_TTL_SECONDS = 12 * 60 * 60
+
+# The signing key comes from KAI_TOKEN_SECRET or [auth] token_secret in the Streamlit secrets.
+# Without one a random key is used, and tokens only survive until the process restarts and
+# only work on this replica.
+TOKEN_SECRET_ENV_VAR = "KAI_TOKEN_SECRET"
+
+_token_secret = None
+
+# Token versions are cached in-process, so restoring a login usually needs no users lookup.
+# The tradeoff: a logout in this process revokes right away, but a token revoked by another
+# app process keeps working here for up to TOKEN_VERSION_TTL_SECONDS.
+TOKEN_VERSION_TTL_SECONDS = 60
+TOKEN_VERSION_MAX_ENTRIES = 1024
+_token_versions = LRUCache(TOKEN_VERSION_MAX_ENTRIES, TOKEN_VERSION_TTL_SECONDS)
+
+logger = logging.getLogger(__name__)
+
 
 # Hashes stored passwords for security
 def hash_password(password):
@@ -23,45 +57,160 @@ def validate_password(password):
         return "Password must contain at least one digit."
     if not re.search("[!@#$%^&*(),.?\":{}|<>]", password):
         return "Password must contain at least one special character."
-    return None  
+    return None
+
+def get_token_secret():
+    global _token_secret
+    if _token_secret is None:
+        secret = os.environ.get(TOKEN_SECRET_ENV_VAR)
+        if not secret:
+            try:
+                secret = st.secrets["auth"]["token_secret"]
+            except Exception:
+                logger.warning(
+                    f"Neither {TOKEN_SECRET_ENV_VAR} nor [auth] token_secret is set. Session tokens are signed "
+                    "with a random key and stop working on restart and on other replicas."
+                )
+                secret = secrets.token_hex(32)
+        _token_secret = secret.encode('utf-8')
+    return _token_secret
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64encode(hmac.new(get_token_secret(), payload.encode('ascii'), hashlib.sha256).digest())
+
+# Signed, expiring token carrying the user's ID, name and token version
+def create_session_token(user_id, username, token_version=0, ttl_seconds=SESSION_TOKEN_TTL_SECONDS):
+    claims = {"uid": user_id, "usr": username, "ver": token_version, "exp": int(time.time()) + ttl_seconds}
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return f"{payload}.{_sign(payload)}"
 
-# Register new user (add username and password to users table in the database)
+# Returns (user_id, username, token_version) for a valid token, None if it is malformed,
+# forged or expired. Whether it was revoked is checked by restore_user_session.
+def verify_session_token(token):
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, UnicodeError):
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims["uid"], claims["usr"], claims.get("ver", 0)
+
+def get_token_version(session, user_id):
+    token_version = _token_versions.get(user_id)
+    if token_version is None:
+        rows = session.sql(
+            "SELECT COALESCE(token_version, 0) AS token_version FROM users WHERE id = ?", (user_id,)
+        ).collect()
+        if not rows:
+            return None
+        token_version = rows[0]['TOKEN_VERSION']
+        _token_versions.put(user_id, token_version)
+    return token_version
+
+# Marks the browser session as logged in and remembers it in the URL
+def start_user_session(user_id, username, token_version=0):
+    st.session_state['logged_in'] = True
+    st.session_state['user_id'] = user_id
+    st.session_state['username'] = username
+    st.query_params[SESSION_TOKEN_PARAM] = create_session_token(user_id, username, token_version)
+
+# Restores a login from the session token in the URL, e.g. after a browser refresh, without
+# a bcrypt check. Tokens issued before the user last logged out are rejected; the version they
+# are checked against is cached (see TOKEN_VERSION_TTL_SECONDS).
+def restore_user_session(session):
+    if st.session_state.get('logged_in'):
+        return True
+    token = st.query_params.get(SESSION_TOKEN_PARAM)
+    user = verify_session_token(token) if token else None
+    if user is None:
+        return False
+    user_id, username, token_version = user
+    try:
+        if get_token_version(session, user_id) != token_version:
+            return False
+    except Exception as e:
+        logger.warning(f"Could not check session token of user {user_id}: {e}")
+        return False
+    st.session_state['logged_in'] = True
+    st.session_state['user_id'] = user_id
+    st.session_state['username'] = username
+    return True
+
+# Logs the browser session out and revokes every session token issued to the user so far
+def logout_user(session):
+    user_id = st.session_state.get('user_id') if st.session_state.get('logged_in') else None
+    if user_id is None:
+        token = st.query_params.get(SESSION_TOKEN_PARAM)
+        user = verify_session_token(token) if token else None
+        user_id = user[0] if user else None
+    if user_id is not None:
+        try:
+            session.sql(
+                "UPDATE users SET token_version = COALESCE(token_version, 0) + 1 WHERE id = ?", (user_id,)
+            ).collect()
+            _token_versions.pop(user_id)
+        except Exception as e:
+            logger.warning(f"Could not revoke session tokens of user {user_id}: {e}")
+    st.session_state['logged_in'] = False
+    st.session_state.pop('user_id', None)
+    st.session_state.pop('username', None)
+    st.query_params.clear()
+
+# Register new user (add username and password to users table in the database). The insert
+# only happens if the username is free, and the new ID is read back in a second query.
 def register_user(session, username, password):
     try:
-        existing_user = session.sql(f"SELECT * FROM users WHERE username = '{username}'").collect()
-        if existing_user:
+        password_error = validate_password(password)
+        if password_error:
+            st.error(password_error)
+            return None
+
+        with st.spinner("Creating account..."):
+            hashed_password = hash_password(password)
+        inserted = session.sql(
+            "MERGE INTO users t USING (SELECT ? AS username, ? AS password_hash) s "
+            "ON t.username = s.username "
+            "WHEN NOT MATCHED THEN INSERT (username, password_hash) VALUES (s.username, s.password_hash)",
+            (username, hashed_password)
+        ).collect()
+        if not inserted or inserted[0][0] == 0:
             st.error('Username already exists. Please choose a different username.')
-        else:
-            password_error = validate_password(password)
-            if password_error:
-                st.error(password_error)  
-            else:
-                hashed_password = hash_password(password)
-                sql_query = f"INSERT INTO users (username, password_hash) VALUES ('{username}', '{hashed_password}')"
-                session.sql(sql_query).collect()  
-                st.session_state['logged_in'] = True
-                st.success('User registered successfully!')
-                user_row = session.table('users').filter(f"username = '{username}'").collect()[0]
-                user_id = user_row['ID'] 
-                st.session_state['user_id'] = user_id
-                return user_id
-            
+            return None
+
+        user_id = session.sql("SELECT id FROM users WHERE username = ?", (username,)).collect()[0]['ID']
+        start_user_session(user_id, username)
+        st.success('User registered successfully!')
+        return user_id
     except Exception as e:
         st.error(f"Error registering user: {e}")
     return None
 
-# Login user by checking username and password against the database
+# Login user by checking username and password against the database. ID, hash and token
+# version are read in one query.
 def login_user(session, username, password):
     try:
-        user_data = session.sql("SELECT password_hash FROM users WHERE username = ?", (username,)).collect()
+        user_data = session.sql(
+            "SELECT id, password_hash, COALESCE(token_version, 0) AS token_version FROM users WHERE username = ?",
+            (username,)
+        ).collect()
         if user_data:
+            user_id = user_data[0]['ID']
             hashed_password = user_data[0]['PASSWORD_HASH']
-            if check_password(hashed_password, password):
-                st.session_state['logged_in'] = True
+            with st.spinner("Checking password..."):
+                password_matches = check_password(hashed_password, password)
+            if password_matches:
+                _token_versions.put(user_id, user_data[0]['TOKEN_VERSION'])
+                start_user_session(user_id, username, user_data[0]['TOKEN_VERSION'])
                 st.success('Logged in successfully!')
-                user_row = session.table('users').filter(f"username = '{username}'").collect()[0]
-                user_id = user_row['ID']  
-                st.session_state['user_id'] = user_id
                 return user_id
 
             else:
@@ -71,4 +220,3 @@ def login_user(session, username, password):
     except Exception as e:
         st.error(f"Error logging in: {e}")
     return None
-
@@ -0,0 +1,51 @@
+import os
+
+from tracing import unwrap_session
+
+
+# Set KAI_BACKEND=local to run the app and the benchmarks against the offline stand-in
+# in local_backend.py instead of a live Snowflake account
+BACKEND_ENV_VAR = "KAI_BACKEND"
+
+
+# Snowpark sessions, Cortex Search services and Cortex Complete from a live Snowflake
+# account. The Snowflake packages are only imported when this backend is used.
+class SnowflakeBackend:
+    needs_credentials = True
+
+    def create_session(self, connection_parameters):
+        from snowflake.snowpark import Session
+        return Session.builder.configs(connection_parameters).create()
+
+    def search_services(self, session, database, schema, service_names):
+        from snowflake.core import Root
+        root = Root(unwrap_session(session))
+        return [
+            root.databases[database].schemas[schema].cortex_search_services[service_name]
+            for service_name in service_names
+        ]
+
+    def complete(self, model_name, prompt, session, stream=False):
+        from snowflake.cortex import Complete
+        return Complete(model_name, prompt, session=unwrap_session(session), stream=stream)
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if os.environ.get(BACKEND_ENV_VAR, "snowflake").lower() == "local":
+            from local_backend import LocalBackend
+            _backend = LocalBackend.from_env()
+        else:
+            _backend = SnowflakeBackend()
+    return _backend
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+# Cortex Complete through the active backend
+def complete(model_name, prompt, session, stream=False):
+    return get_backend().complete(model_name, prompt, session, stream=stream)
@@ -0,0 +1,230 @@
+"""Answers a fixed list of questions with one or more models, without the Streamlit UI:
+
+    python batch.py questions.jsonl --output answers.jsonl --models mistral-large llama3-70b --concurrency 8
+
+Every input line is a JSON object with a "question" and optionally an "id" and "categories".
+Results are appended to the output file as soon as they are ready, one JSON object per
+(question, model). The output file is also the checkpoint: a rerun with the same output skips
+every (id, model) pair that already has an answer and retries those that failed.
+
+A model that is throttled or times out falls back to another one, as in the app. Such an
+answer is written with the model that gave it in "answered_by" and as an error, so a rerun
+asks the requested model again.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import get_backend
+from config import (
+    COLUMNS, CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICES, MODEL_DESCRIPTIONS,
+    NUM_CANDIDATE_CHUNKS, NUM_CHUNKS
+)
+from governor import governor
+from pipeline import generate_answer
+from resources import SessionPool
+from retrieval import build_category_filter, chunk_id, search_all
+from routing import Routing
+from tracing import TracedSession, submit, tracer
+
+
+DEFAULT_CONCURRENCY = 8
+
+# Searches are cheap next to completions, so a few of them run ahead of the answer workers
+SEARCH_CONCURRENCY = 4
+
+# Snowflake credentials for headless runs, mirroring the [snowflake] Streamlit secrets
+CONNECTION_ENV_VARS = {
+    "account": "SNOWFLAKE_ACCOUNT",
+    "user": "SNOWFLAKE_USER",
+    "password": "SNOWFLAKE_PASSWORD",
+    "authenticator": "SNOWFLAKE_AUTHENTICATOR",
+    "role": "SNOWFLAKE_ROLE",
+    "warehouse": "SNOWFLAKE_WAREHOUSE",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def connection_parameters_from_env():
+    parameters = {name: os.environ.get(env_var) for name, env_var in CONNECTION_ENV_VARS.items()}
+    parameters["database"] = CORTEX_SEARCH_DATABASE
+    parameters["schema"] = CORTEX_SEARCH_SCHEMA
+    return {name: value for name, value in parameters.items() if value is not None}
+
+# Reads the questions, numbering those without an "id" by their line
+def load_questions(path):
+    questions = []
+    with open(path) as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record.get("question"):
+                raise ValueError(f"{path}:{line_number}: missing \"question\"")
+            record.setdefault("id", line_number)
+            questions.append(record)
+    return questions
+
+# (id, model) pairs already answered in an earlier run of the same output file
+def load_completed(path):
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be cut off if the previous run was killed mid-write
+                continue
+            if record.get("error") is None:
+                completed.add((record["id"], record["model"]))
+    return completed
+
+
+# Runs every question against every model. Retrieval runs once per question and is shared by
+# all models; the completions then run on a pool of `concurrency` workers, so throughput
+# grows with the number of Cortex calls allowed in flight.
+class BatchRunner:
+    def __init__(self, session_pool, search_services, model_names, output_path,
+                 concurrency=DEFAULT_CONCURRENCY, summarize=True):
+        self.session_pool = session_pool
+        self.search_services = search_services
+        self.model_names = list(model_names)
+        self.output_path = output_path
+        self.concurrency = concurrency
+        self.summarize = summarize
+        self.written = 0
+        self.failed = 0
+        self._output = None
+        self._lock = threading.Lock()
+
+    def run(self, questions):
+        completed = load_completed(self.output_path)
+        jobs = []
+        for question in questions:
+            models = [model for model in self.model_names if (question["id"], model) not in completed]
+            if models:
+                jobs.append((question, models))
+        skipped = len(questions) * len(self.model_names) - sum(len(models) for _, models in jobs)
+        if skipped:
+            logger.info(f"Resuming: {skipped} answers already in {self.output_path}")
+
+        with open(self.output_path, "a") as self._output, \
+                ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY, thread_name_prefix="batch-search") as search_pool, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch-answer") as answer_pool:
+            retrievals = [(question, models, submit(search_pool, self.retrieve, question)) for question, models in jobs]
+            answers = []
+            for question, models, retrieval in retrievals:
+                try:
+                    candidates = retrieval.result()
+                except Exception as e:
+                    for model_name in models:
+                        self.write(question, model_name, error=f"Search failed: {e}")
+                    continue
+                for model_name in models:
+                    answers.append(submit(answer_pool, self.answer, question, model_name, candidates))
+            for future in answers:
+                future.result()
+        return self.written, self.failed
+
+    def retrieve(self, question):
+        search_filter = build_category_filter(question.get("categories"))
+        return search_all(self.search_services, question["question"], COLUMNS, NUM_CANDIDATE_CHUNKS, search_filter)
+
+    def answer(self, question, model_name, candidates):
+        started_at = time.perf_counter()
+        routing = Routing()
+        try:
+            with tracer.trace("turn", model_name, question["question"]):
+                answer, summary, prompt_context = generate_answer(
+                    self.session_pool.get(), model_name, question["question"], candidates, NUM_CHUNKS,
+                    summarize=self.summarize, routing=routing
+                )
+        except Exception as e:
+            self.write(question, model_name, error=str(e))
+            return
+        error = None
+        if routing.model_name != model_name:
+            error = f"{model_name} was unavailable, {routing.model_name} answered instead"
+        self.write(
+            question, model_name, answer=answer, summary=summary,
+            sources=[chunk_id(result) for result in prompt_context],
+            latency_ms=int((time.perf_counter() - started_at) * 1000), answered_by=routing.model_name, error=error
+        )
+
+    # Appends one result and flushes it, so a killed run loses at most the answers in flight
+    def write(self, question, model_name, answer=None, summary=None, sources=None, latency_ms=None,
+              answered_by=None, error=None):
+        record = {
+            "id": question["id"],
+            "question": question["question"],
+            "model": model_name,
+            "answered_by": answered_by,
+            "answer": answer,
+            "summary": summary,
+            "sources": sources,
+            "latency_ms": latency_ms,
+            "error": error,
+        }
+        with self._lock:
+            self._output.write(json.dumps(record) + "\n")
+            self._output.flush()
+            self.written += 1
+            if error is not None:
+                self.failed += 1
+                logger.warning(f"{question['id']} / {model_name}: {error}")
+            else:
+                logger.info(f"{question['id']} / {model_name}: answered in {latency_ms} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="JSONL file with one question per line")
+    parser.add_argument("--output", required=True, help="JSONL file the answers are appended to")
+    parser.add_argument("--models", nargs="+", default=list(MODEL_DESCRIPTIONS), choices=list(MODEL_DESCRIPTIONS),
+                        metavar="MODEL", help="models to answer with (default: all)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="number of questions answered at the same time (default: %(default)s). At most "
+                             "the Cortex calls the process allows per model (\"concurrency\" in "
+                             "config.MODEL_DESCRIPTIONS) run at once; a higher value is lowered to their sum "
+                             "over the selected models, since extra workers would only queue and then be shed")
+    parser.add_argument("--no-summary", action="store_true", help="skip the summary of every answer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    max_concurrency = sum(governor.limit(model_name) for model_name in args.models)
+    if args.concurrency > max_concurrency:
+        logger.warning(f"--concurrency {args.concurrency} lowered to {max_concurrency}, the Cortex calls "
+                       f"allowed in flight for {', '.join(args.models)}")
+        args.concurrency = max_concurrency
+
+    backend = get_backend()
+    session_pool = SessionPool(
+        lambda: TracedSession(backend.create_session(connection_parameters_from_env())), size=args.concurrency
+    )
+    search_services = backend.search_services(
+        session_pool.get(), CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICES
+    )
+
+    runner = BatchRunner(session_pool, search_services, args.models, args.output, args.concurrency,
+                         summarize=not args.no_summary)
+    started_at = time.perf_counter()
+    written, failed = runner.run(load_questions(args.questions))
+    elapsed = time.perf_counter() - started_at
+    logger.info(f"Wrote {written} answers ({failed} failed) in {elapsed:.1f} s")
+    for stage, stats in tracer.stats().items():
+        logger.info(f"{stage}: {stats['count']} calls, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms")
+    session_pool.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
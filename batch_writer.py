@@ -0,0 +1,58 @@
+import atexit
+import queue
+import threading
+import time
+
+
+# A batch is written as soon as it has this many records...
+BATCH_SIZE = 50
+# ...or once its oldest record has waited this many seconds
+FLUSH_INTERVAL_SECONDS = 5.0
+
+
+# Collects records queued from the request path and hands them to `_flush` in batches from a
+# background thread, so writes never block a turn and need one round trip per batch.
+# Subclasses implement `_flush(batch)`.
+class BatchWriter:
+    def __init__(self, session_pool, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 thread_name="batch-writer"):
+        self.session_pool = session_pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=thread_name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, record):
+        self._queue.put(record)
+
+    # Stops the writer thread after everything queued so far has been written
+    def close(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while not (self._stopped.is_set() and self._queue.empty()):
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                batch.append(self._queue.get(timeout=min(timeout, 0.5)))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or self._stopped.is_set()):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        raise NotImplementedError
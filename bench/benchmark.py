@@ -0,0 +1,291 @@
+"""End-to-end latency benchmark for the question answering flows, run against the
+offline stand-in backend:
+
+    python -m bench.benchmark --latency-scale 0.1 --jitter 0.2
+
+Reports per-turn latency (p50/p95), round trips per turn (SQL, search, Complete) and prompt
+sizes for the recommendation, paraphrase, chat-with-history and past-chat flows, followed by
+the p50/p95 latency of every traced pipeline stage, the Cortex calls queued, retried and
+shed per model, and the size of the conversation memory.
+"""
+import argparse
+import json
+import time
+from collections import Counter
+
+from backend import set_backend
+from cache import answer_cache
+from context import estimate_tokens
+from config import COLUMNS, CORTEX_SEARCH_SERVICES, NUM_CANDIDATE_CHUNKS, NUM_CHUNKS
+from conversation_memory import ConversationMemory
+from conversations import ConversationStore
+from local_backend import DEFAULT_CORPUS_PATH, DEFAULT_LATENCY, DEFAULT_ANSWER_TOKENS, LocalBackend, load_corpus
+from pipeline import answer_turn, finish_turn, start_turn
+from resources import SessionPool
+from retrieval import chunk_id, is_self_contained, search_cache
+from governor import governor
+from semantic_cache import semantic_cache
+from tracing import TracedSession, percentile, tracer
+
+
+RECOMMENDATION_QUESTIONS = [
+    "What was WK Kellogg Co's revenue for 2023?",
+    "How did WK Kellogg Co compete with General Mills?",
+    "What are the top product categories in the cereal industry?",
+    "What are the health trends affecting cereal sales?",
+    "What are the key risks facing the cereal industry?",
+]
+
+# The recommendation questions in other words, as users type them
+PARAPHRASES = [
+    "WK Kellogg revenue 2023",
+    "How did WK Kellogg Co compete against General Mills?",
+    "Which product categories are the top ones in the cereal industry?",
+    "Health trends affecting cereal sales",
+    "Key risks facing the cereal industry",
+]
+
+CONVERSATION = [
+    "What was WK Kellogg Co's revenue for 2023?",
+    "How did that compare with General Mills?",
+    "What drove the change in their margins?",
+    "What are the key sustainability initiatives WK Kellogg Co has implemented?",
+    "Tell me more about those.",
+]
+
+BENCHMARK_USER_ID = 1
+
+
+# Runs one turn through the same pipeline calls as app.answer_question, without streaming.
+# Returns the answer, the time until the answer was ready and the time until the deferred
+# summary was ready.
+def run_turn(session, search_services, model_name, question, conversation):
+    with tracer.trace("turn", model_name, question):
+        return _run_turn(session, search_services, model_name, question, conversation)
+
+def _run_turn(session, search_services, model_name, question, conversation):
+    started_at = time.perf_counter()
+    if is_self_contained(question):
+        conversation = ""
+    turn = start_turn(
+        session, model_name, search_services, question, conversation, COLUMNS, NUM_CANDIDATE_CHUNKS, NUM_CHUNKS
+    )
+    if turn.cached:
+        answer_latency = time.perf_counter() - started_at
+        return turn.answer, turn.summary, turn.prompt_context, turn.prompt, answer_latency, answer_latency
+
+    answer = answer_turn(session, turn)
+    answer_latency = time.perf_counter() - started_at
+    summary = finish_turn(session, turn, answer).result()
+    return answer, summary, turn.prompt_context, turn.prompt, answer_latency, time.perf_counter() - started_at
+
+
+class FlowResult:
+    def __init__(self, name):
+        self.name = name
+        self.answer_latencies = []
+        self.total_latencies = []
+        self.round_trips = []
+        self.prompt_tokens = []
+
+    def add(self, answer_latency, total_latency, round_trips, prompt_tokens=None):
+        self.answer_latencies.append(answer_latency)
+        self.total_latencies.append(total_latency)
+        self.round_trips.append(round_trips)
+        if prompt_tokens is not None:
+            self.prompt_tokens.append(prompt_tokens)
+
+    def report(self):
+        turns = len(self.answer_latencies)
+
+        def average_calls(kind):
+            return sum(calls.get(kind, 0) for calls in self.round_trips) / turns if turns else 0.0
+
+        return {
+            "flow": self.name,
+            "turns": turns,
+            "answer_p50_ms": round(percentile(self.answer_latencies, 0.5) * 1000, 1),
+            "answer_p95_ms": round(percentile(self.answer_latencies, 0.95) * 1000, 1),
+            "total_p50_ms": round(percentile(self.total_latencies, 0.5) * 1000, 1),
+            "total_p95_ms": round(percentile(self.total_latencies, 0.95) * 1000, 1),
+            "sql_per_turn": round(average_calls("sql"), 2),
+            "search_per_turn": round(average_calls("search"), 2),
+            "complete_per_turn": round(average_calls("complete"), 2),
+            "avg_prompt_tokens": round(sum(self.prompt_tokens) / len(self.prompt_tokens), 1) if self.prompt_tokens else 0,
+        }
+
+
+class Benchmark:
+    def __init__(self, backend, model_name, repeat):
+        self.backend = backend
+        self.model_name = model_name
+        self.repeat = repeat
+        set_backend(backend)
+        self.session_pool = SessionPool(lambda: TracedSession(backend.create_session({})), size=1)
+        self.session = self.session_pool.get()
+        self.search_services = backend.search_services(self.session, None, None, CORTEX_SEARCH_SERVICES)
+        self.memory_stats = []
+
+    def reset_caches(self):
+        answer_cache.memory.clear()
+        semantic_cache.clear()
+        self.backend.answer_cache.clear()
+        search_cache.clear()
+
+    def measure_turn(self, result, question, conversation):
+        self.backend.reset_stats()
+        answer, summary, prompt_context, prompt, answer_latency, total_latency = run_turn(
+            self.session, self.search_services, self.model_name, question, conversation
+        )
+        result.add(answer_latency, total_latency, dict(self.backend.calls), estimate_tokens(prompt))
+        return answer, summary, prompt_context
+
+    # Fresh sessions clicking a recommendation: first click (cold caches) and repeat clicks
+    def recommendation_flow(self):
+        cold = FlowResult("recommendation (cold)")
+        warm = FlowResult("recommendation (cached)")
+        for _ in range(self.repeat):
+            self.reset_caches()
+            for question in RECOMMENDATION_QUESTIONS:
+                self.measure_turn(cold, question, "")
+            for question in RECOMMENDATION_QUESTIONS:
+                self.measure_turn(warm, question, "")
+        return [cold, warm]
+
+    # Recommendation questions followed by rephrasings of them, which the semantic cache
+    # answers without retrieval or a Complete call
+    def paraphrase_flow(self):
+        result = FlowResult("paraphrase (semantic cache)")
+        for _ in range(self.repeat):
+            self.reset_caches()
+            for question in RECOMMENDATION_QUESTIONS:
+                run_turn(self.session, self.search_services, self.model_name, question, "")
+            for question in PARAPHRASES:
+                self.measure_turn(result, question, "")
+        return [result]
+
+    # A multi-turn conversation with follow-ups that are rewritten against the conversation memory
+    def chat_with_history_flow(self):
+        result = FlowResult("chat with history")
+        for _ in range(self.repeat):
+            self.reset_caches()
+            memory = ConversationMemory()
+            for question in CONVERSATION:
+                conversation = "" if is_self_contained(question) else memory.context()
+                answer, _, _ = self.measure_turn(result, question, conversation)
+                memory.add_turn(self.session, self.model_name, question, answer)
+            self.memory_stats.append(memory.stats())
+        return [result]
+
+    # Stores the conversation turns, then replays each one from "Past Chats"
+    def past_chat_flow(self):
+        cold = FlowResult("past chat replay (cold)")
+        warm = FlowResult("past chat replay (cached)")
+        for _ in range(self.repeat):
+            self.reset_caches()
+            store = ConversationStore(self.session_pool)
+            saved_turns = 0
+            for question in CONVERSATION:
+                answer, summary, prompt_context, _, _, _ = run_turn(
+                    self.session, self.search_services, self.model_name, question, []
+                )
+                store.save_turn(BENCHMARK_USER_ID, question, answer, summary,
+                                [chunk_id(result) for result in prompt_context], self.model_name)
+                saved_turns += 1
+            turns = self.wait_for_turns(store, saved_turns)
+
+            for replay in (cold, warm):
+                for turn in turns:
+                    self.backend.reset_stats()
+                    started_at = time.perf_counter()
+                    store.get_turn(self.session, BENCHMARK_USER_ID, turn.id)
+                    latency = time.perf_counter() - started_at
+                    replay.add(latency, latency, dict(self.backend.calls))
+        return [cold, warm]
+
+    def wait_for_turns(self, store, expected, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            turns = store.list_turns(self.session, BENCHMARK_USER_ID, limit=expected).turns
+            if len(turns) >= expected:
+                return turns
+            time.sleep(0.05)
+        raise TimeoutError("Conversation turns were not written in time")
+
+    def run(self):
+        results = []
+        results += self.recommendation_flow()
+        results += self.paraphrase_flow()
+        results += self.chat_with_history_flow()
+        results += self.past_chat_flow()
+        return [result.report() for result in results]
+
+
+def print_table(reports):
+    columns = list(reports[0].keys())
+    widths = [max(len(column), *(len(str(report[column])) for report in reports)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for report in reports:
+        print("  ".join(str(report[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_PATH, help="JSONL corpus for the local search service")
+    parser.add_argument("--model", default="mistral-large")
+    parser.add_argument("--repeat", type=int, default=3, help="how often every flow is run")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every latency below")
+    parser.add_argument("--sql-latency", type=float, default=DEFAULT_LATENCY["sql"])
+    parser.add_argument("--search-latency", type=float, default=DEFAULT_LATENCY["search"])
+    parser.add_argument("--complete-latency", type=float, default=DEFAULT_LATENCY["complete"])
+    parser.add_argument("--token-latency", type=float, default=DEFAULT_LATENCY["token"])
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative jitter, e.g. 0.2 for +/-20%%")
+    parser.add_argument("--answer-tokens", type=int, default=DEFAULT_ANSWER_TOKENS)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--throttle", action="append", default=[], metavar="MODEL",
+                        help="reject Complete calls to this model as throttled (repeatable)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of all other Complete calls rejected as throttled, e.g. 0.2")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    latency = {
+        "sql": args.sql_latency * args.latency_scale,
+        "search": args.search_latency * args.latency_scale,
+        "complete": args.complete_latency * args.latency_scale,
+        "token": args.token_latency * args.latency_scale,
+    }
+    backend = LocalBackend(load_corpus(args.corpus), latency=latency, jitter=args.jitter,
+                           answer_tokens=args.answer_tokens, seed=args.seed, throttled_models=args.throttle,
+                           throttle_rate=args.throttle_rate)
+    benchmark = Benchmark(backend, args.model, args.repeat)
+    reports = benchmark.run()
+
+    stages = [dict(stage=stage, **stats) for stage, stats in tracer.stats().items()]
+    governed_calls = [dict(key=key, **stats) for key, stats in governor.stats().items()]
+    model_calls = Counter(
+        (span.stage, span.model_name, span.error or "") for span in tracer.recent_spans() if span.stage != "turn" and span.model_name
+    )
+    models = [
+        {"stage": stage, "model": model_name, "error": error, "calls": calls}
+        for (stage, model_name, error), calls in sorted(model_calls.items())
+    ]
+
+    print_table(reports)
+    print()
+    print_table(stages)
+    print()
+    print_table(models)
+    print()
+    print_table(governed_calls)
+    print()
+    print_table(benchmark.memory_stats)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"flows": reports, "stages": stages, "models": models, "calls": governed_calls,
+                       "memory": benchmark.memory_stats},
+                      file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
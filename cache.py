@@ -0,0 +1,103 @@
+import hashlib
+import re
+import threading
+import time
+
+from lru import LRUCache
+from retrieval import chunk_id, invalidate_search_cache
+
+
+# How long a cached answer stays valid (24 hours)
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 512
+
+# The search service refreshes with TARGET_LAG = '1 minute', so the index version only
+# needs to be re-read about that often
+INDEX_VERSION_TTL_SECONDS = 60
+
+
+# Lower-cases the question and collapses whitespace and trailing punctuation so that
+# trivially different spellings of the same question share a cache entry
+def normalize_question(question):
+    question = re.sub(r'\s+', ' ', question.strip().lower())
+    return question.rstrip('?!. ')
+
+# Hashes the IDs of the retrieved chunks, independent of their order
+def context_fingerprint(results):
+    ids = sorted(chunk_id(result) for result in results)
+    return hashlib.sha256('\n'.join(ids).encode('utf-8')).hexdigest()
+
+def answer_cache_key(model_name, question, results):
+    raw_key = '\n'.join([model_name, normalize_question(question), context_fingerprint(results)])
+    return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+_index_version = {"value": None, "checked_at": 0.0}
+_index_version_lock = threading.Lock()
+
+# Returns a value that changes whenever the indexed chunk table changes, so cached
+# answers built on older data can be recognised as stale. Cached search results are
+# dropped when it changes.
+def get_index_version(session):
+    with _index_version_lock:
+        if time.monotonic() - _index_version["checked_at"] < INDEX_VERSION_TTL_SECONDS:
+            return _index_version["value"]
+        previous = _index_version["value"]
+        try:
+            row = session.sql("SELECT SYSTEM$LAST_CHANGE_COMMIT_TIME('DOCS_CHUNKS_TABLE') AS version").collect()[0]
+            _index_version["value"] = str(row['VERSION'])
+        except Exception:
+            _index_version["value"] = None
+        if previous is not None and _index_version["value"] not in (None, previous):
+            invalidate_search_cache()
+        _index_version["checked_at"] = time.monotonic()
+        return _index_version["value"]
+
+
+# Two-tier answer cache: an in-process LRU in front of the answer_cache table
+# (see sql/login.sql), which is shared by every app process
+class AnswerCache:
+    def __init__(self, maxsize=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(maxsize, ttl_seconds)
+
+    # Returns (answer, summary) or None. Entries built on another index version are ignored.
+    def get(self, session, key, index_version):
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry["index_version"] == index_version:
+                return entry["answer"], entry["summary"]
+            self.memory.pop(key)
+
+        try:
+            rows = session.sql(
+                "SELECT answer, summary, index_version FROM answer_cache "
+                "WHERE cache_key = ? AND created_at >= DATEADD(second, ?, CURRENT_TIMESTAMP())",
+                (key, -self.ttl_seconds)
+            ).collect()
+        except Exception:
+            return None
+
+        if not rows or rows[0]['INDEX_VERSION'] != index_version:
+            return None
+
+        answer, summary = rows[0]['ANSWER'], rows[0]['SUMMARY']
+        self.memory.put(key, {"answer": answer, "summary": summary, "index_version": index_version})
+        return answer, summary
+
+    def put(self, session, key, model_name, question, answer, summary, index_version):
+        self.memory.put(key, {"answer": answer, "summary": summary, "index_version": index_version})
+        try:
+            session.sql(
+                "MERGE INTO answer_cache t USING (SELECT ? AS cache_key) s ON t.cache_key = s.cache_key "
+                "WHEN MATCHED THEN UPDATE SET answer = ?, summary = ?, index_version = ?, created_at = CURRENT_TIMESTAMP() "
+                "WHEN NOT MATCHED THEN INSERT (cache_key, model_name, question, answer, summary, index_version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, answer, summary, index_version, key, model_name, question, answer, summary, index_version)
+            ).collect()
+        except Exception:
+            # The in-memory tier still serves this process if the shared table is unavailable
+            pass
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,88 @@
+# Settings shared by the Streamlit app, the batch runner and the benchmark
+
+### Default Values
+NUM_CHUNKS = 3
+NUM_CANDIDATE_CHUNKS = 8
+
+# Service parameters
+CORTEX_SEARCH_DATABASE = "CC_QUICKSTART_CORTEX_SEARCH_DOCS"
+CORTEX_SEARCH_SCHEMA = "DATA"
+CORTEX_SEARCH_SERVICE = "CC_SEARCH_SERVICE_CS"
+
+# Every Cortex Search service queried for context. They are searched in parallel and
+# their results are merged with reciprocal rank fusion, so add a corpus here to include it.
+CORTEX_SEARCH_SERVICES = [
+    CORTEX_SEARCH_SERVICE
+]
+
+# Columns to query in the service
+COLUMNS = [
+    "chunk",
+    "relative_path",
+    "category"
+]
+
+# Full pool of potential button texts
+BUTTON_TEXTS = [
+    "What was WK Kellogg Co's revenue for 2023?",
+    "How did WK Kellogg Co compete with General Mills?",
+    "What are the top product categories in the cereal industry?",
+    "What are the health trends affecting cereal sales?",
+    "How is the cereal industry adapting to consumer preferences?",
+    "How has WK Kellogg Co's market share evolved from 2019 to 2023?",
+    "What are the key sustainability initiatives WK Kellogg Co has implemented?",
+    "What are the major trends in consumer preferences affecting cereal sales?",
+    "What are the top-performing products for General Mills in recent years?",
+    "How has the COVID-19 pandemic impacted the cereal industry?",
+    "What are the key risks facing the cereal industry?",
+    "How have health-conscious trends influenced cereal product development?",
+    "What are the major marketing strategies used by WK Kellogg Co?",
+    "How has General Mills invested in product innovation?",
+    "What are the revenue growth projections for the cereal industry through 2025?"
+]
+
+# Every model offered in the app:
+#   description     shown in the sidebar and the model documentation
+#   latency, cost   tiers from 1 (fastest or cheapest) to 3; cost follows the Cortex credits
+#                   per million tokens. routing.py picks the model of each step by them.
+#   context_window  tokens the model takes, which bounds the retrieved context (context.py)
+#   concurrency     calls allowed in flight per process (governor.py). The large models are
+#                   throttled first, so they get fewer.
+MODEL_DESCRIPTIONS = {
+    'mixtral-8x7b': {
+        'description': "Mixtral-8x7b is an open-source transformer model, ideal for general text processing tasks such as summarization, classification, and answering questions. It performs well on medium-sized to large datasets.",
+        'latency': 2, 'cost': 1, 'context_window': 32000, 'concurrency': 16,
+    },
+    'snowflake-arctic': {
+        'description': "Snowflake-Arctic is a model optimized for financial analysis and forecasting. It excels in analyzing large datasets with particular optimization for Snowflake's data lake and warehouse ecosystems.",
+        'latency': 2, 'cost': 2, 'context_window': 4096, 'concurrency': 8,
+    },
+    'mistral-large': {
+        'description': "Mistral-Large is a high-performance model tailored for language generation tasks. It's great for content creation, including generating emails, reports, and marketing copy.",
+        'latency': 3, 'cost': 3, 'context_window': 32000, 'concurrency': 8,
+    },
+    'llama3-8b': {
+        'description': "Llama3-8b is a powerful, general-purpose language model.It is highly optimized for maintaining coherence and structure across complex and nuanced tasks generating structured content like formal reports and conversational agents requiring adherence to format",
+        'latency': 1, 'cost': 1, 'context_window': 8000, 'concurrency': 16,
+    },
+    'llama3-70b': {
+        'description': "Llama3-70b is a massive model capable of handling highly complex tasks with a deep understanding of nuanced language patterns. Ideal for advanced research or industry-specific NLP tasks.",
+        'latency': 3, 'cost': 3, 'context_window': 8000, 'concurrency': 8,
+    },
+    'reka-flash': {
+        'description': "Reka-Flash is a lightweight model designed for fast inference and quick responses. It's suitable for low-latency applications like real-time chatbots or recommendation systems.",
+        'latency': 1, 'cost': 2, 'context_window': 100000, 'concurrency': 16,
+    },
+    'mistral-7b': {
+        'description': "Mistral-7b is a balanced model that offers a good trade-off between performance and computational efficiency. It's useful for general NLP tasks without requiring massive compute resources.",
+        'latency': 1, 'cost': 1, 'context_window': 32000, 'concurrency': 16,
+    },
+    'llama2-70b-chat': {
+        'description': "Llama2-70b-Chat is optimized for conversational AI, providing human-like dialogue capabilities. It works best in chat applications, support bots, and virtual assistants.",
+        'latency': 3, 'cost': 2, 'context_window': 4096, 'concurrency': 8,
+    },
+    'gemma-7b': {
+        'description': "Gemma-7b is fine-tuned for creative tasks like writing, generating ideas, and crafting compelling stories or articles. It's ideal for content marketers and creative professionals.",
+        'latency': 1, 'cost': 1, 'context_window': 8000, 'concurrency': 16,
+    },
+}
@@ -0,0 +1,112 @@
+import math
+import re
+
+from config import MODEL_DESCRIPTIONS
+
+
+# Context window (in tokens) of models missing from MODEL_DESCRIPTIONS
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Tokens kept free for the instructions, the question and the generated answer
+RESERVED_PROMPT_TOKENS = 800
+RESERVED_ANSWER_TOKENS = 2048
+
+# Upper bound on context tokens even for models with very large windows
+MAX_CONTEXT_TOKENS = 3000
+
+# pdf_text_chunker splits with a 256 character overlap; anything shorter than
+# MIN_OVERLAP_CHARS is treated as a coincidence rather than an overlap
+MAX_OVERLAP_CHARS = 320
+MIN_OVERLAP_CHARS = 40
+
+# Trade-off between relevance (1.0) and diversity (0.0) when reranking chunks
+MMR_LAMBDA = 0.7
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+# Rough token count for English text (about four characters per token)
+def estimate_tokens(text):
+    return math.ceil(len(text) / 4)
+
+# Number of context tokens a model can take on top of the instructions and its answer
+def context_token_budget(model_name):
+    window = MODEL_DESCRIPTIONS.get(model_name, {}).get('context_window', DEFAULT_CONTEXT_WINDOW)
+    return max(0, min(MAX_CONTEXT_TOKENS, window - RESERVED_PROMPT_TOKENS - RESERVED_ANSWER_TOKENS))
+
+def _word_set(text):
+    return set(WORD_PATTERN.findall(text.lower()))
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+# Reorders the chunks with maximal marginal relevance: each pick balances the chunk's rank
+# from search against how similar it is to the chunks already picked
+def mmr_rerank(results, max_chunks, mmr_lambda=MMR_LAMBDA):
+    if not results:
+        return []
+
+    relevance = [1.0 - rank / len(results) for rank in range(len(results))]
+    words = [_word_set(result.get('chunk', '')) for result in results]
+    remaining = list(range(len(results)))
+    selected = []
+
+    while remaining and len(selected) < max_chunks:
+        def mmr_score(i):
+            redundancy = max((_jaccard(words[i], words[j]) for j in selected), default=0.0)
+            return mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+
+        best = max(remaining, key=mmr_score)
+        selected.append(best)
+        remaining.remove(best)
+
+    return [results[i] for i in selected]
+
+# Length of the longest suffix of `first` that is also a prefix of `second`
+def _overlap_length(first, second):
+    for length in range(min(len(first), len(second), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+# Removes the text a chunk shares with an earlier chunk of the same document. Results are
+# copied rather than modified, since they may be shared through the search cache.
+def strip_chunk_overlap(results):
+    stripped = []
+    for result in results:
+        chunk = result.get('chunk', '')
+        for previous in stripped:
+            if previous.get('relative_path') != result.get('relative_path'):
+                continue
+            overlap = _overlap_length(previous['chunk'], chunk)
+            if overlap:
+                chunk = chunk[overlap:]
+                continue
+            overlap = _overlap_length(chunk, previous['chunk'])
+            if overlap:
+                chunk = chunk[:-overlap]
+        stripped.append(dict(result, chunk=chunk.strip()))
+    return [result for result in stripped if result['chunk']]
+
+def format_chunk(index, result):
+    return f"[{index}] Source: {result.get('relative_path', 'unknown')}\n{result['chunk']}"
+
+# Turns the candidate chunks into the context block of the prompt: rerank for diversity,
+# strip overlapping text and pack as many chunks as fit in the model's token budget.
+# Returns the context text and the chunks that made it in.
+def assemble_context(results, model_name, max_chunks):
+    budget = context_token_budget(model_name)
+    packed = []
+    blocks = []
+    used_tokens = 0
+    for result in strip_chunk_overlap(mmr_rerank(results, max_chunks)):
+        block = format_chunk(len(packed) + 1, result)
+        block_tokens = estimate_tokens(block)
+        if used_tokens + block_tokens > budget:
+            continue
+        packed.append(result)
+        blocks.append(block)
+        used_tokens += block_tokens
+    return "\n\n".join(blocks), packed
@@ -0,0 +1,153 @@
+import logging
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from context import estimate_tokens
+from routing import routed_complete
+from tracing import submit
+
+
+# The rolling summary is cut to this many words, so the rewrite prompt stays the same size
+# however long the conversation runs
+MEMORY_SUMMARY_MAX_WORDS = 120
+MEMORY_MAX_ENTITIES = 12
+
+# Only the start of an answer goes into the summary update; answers are multi-page analyses
+MEMORY_ANSWER_MAX_WORDS = 400
+
+# How long a rewrite waits for the update of the previous turn before using the older summary.
+# The last question is always there verbatim, so a quick follow-up loses little by not waiting.
+MEMORY_WAIT_SECONDS = 1
+
+# The rewrite used to be sent the last RAW_HISTORY_WINDOW messages as they were. Tokens saved
+# are counted against that window.
+RAW_HISTORY_WINDOW = 7
+
+# Names, fiscal periods and amounts worth keeping across turns: capitalized phrases
+# ("WK Kellogg Co", "General Mills"), years, quarters and dollar amounts
+ENTITY_PATTERN = re.compile(
+    r"\$\s?\d[\d,.]*(?:\s(?:million|billion))?"
+    r"|\b(?:FY\s?)?(?:19|20)\d{2}\b"
+    r"|\bQ[1-4]\b"
+    r"|\b[A-Z][\w&'.-]*(?:\s+[A-Z][\w&'.-]*)*"
+)
+# Capitalized only because they start a sentence
+ENTITY_STOP_WORDS = {
+    "A", "An", "And", "Are", "As", "At", "But", "By", "Can", "Compare", "Could", "Did", "Do", "Does", "For",
+    "Give", "How", "I", "If", "In", "Is", "It", "Its", "List", "On", "Overall", "Please", "Show", "So",
+    "Tell", "The", "There", "These", "This", "Those", "To", "Was", "We", "What", "When", "Where", "Which",
+    "While", "Who", "Why", "With",
+}
+
+# Summary updates of every session run here, after the turn has been answered
+_memory_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory")
+
+logger = logging.getLogger(__name__)
+
+
+def extract_entities(text):
+    entities = []
+    for match in ENTITY_PATTERN.findall(text):
+        words = match.split()
+        while words and words[0] in ENTITY_STOP_WORDS:
+            words = words[1:]
+        if words:
+            entities.append(" ".join(words).rstrip(".'"))
+    return entities
+
+def truncate_words(text, max_words):
+    words = text.split()
+    return text if len(words) <= max_words else " ".join(words[:max_words]) + " ..."
+
+
+# What the query rewrite knows about a conversation: a rolling summary, updated once per turn
+# in the background, the entities discussed and the last question. Each answer is sent to the
+# model once, for the update of its turn, instead of with every following rewrite.
+class ConversationMemory:
+    def __init__(self):
+        self.summary = ""
+        self.entities = []
+        self.last_question = None
+        self.turns = 0
+        self.rewrites = 0
+        self.tokens_saved = 0
+        # Token counts of the messages the raw sliding window would have held
+        self._raw_window = deque(maxlen=RAW_HISTORY_WINDOW)
+        self._pending = None
+        self._lock = threading.Lock()
+
+    # Records an answered turn and starts the summary update for it. Updates run one after
+    # the other, each on the summary left by the previous one.
+    def add_turn(self, session, model_name, question, answer):
+        with self._lock:
+            self.turns += 1
+            self.last_question = question
+            self._raw_window.extend([estimate_tokens(question), estimate_tokens(answer)])
+            entities = extract_entities(question)
+            # Of the answer only names that come up repeatedly are kept
+            answer_entities = extract_entities(answer)
+            entities += [entity for entity in answer_entities if answer_entities.count(entity) > 1]
+            for entity in entities:
+                if entity in self.entities:
+                    self.entities.remove(entity)
+                self.entities.append(entity)
+            del self.entities[:-MEMORY_MAX_ENTITIES]
+            self._pending = submit(
+                _memory_executor, self._update_summary, self._pending, session, model_name, question, answer
+            )
+
+    def _update_summary(self, previous, session, model_name, question, answer):
+        if previous is not None:
+            try:
+                previous.result()
+            except Exception:
+                pass
+        prompt = f"""
+        Update the summary of a conversation with a financial analyst assistant with its latest turn.
+        Keep the companies, products, periods and figures the user is interested in. Answer with
+        only the updated summary, in at most {MEMORY_SUMMARY_MAX_WORDS} words.
+<summary>{self.summary}</summary>
+<question>{question}</question>
+<answer>{truncate_words(answer, MEMORY_ANSWER_MAX_WORDS)}</answer>
+"""
+        try:
+            summary = routed_complete("memory", model_name, prompt, session)
+        except Exception as e:
+            logger.warning(f"Could not update conversation memory: {e}")
+            return
+        with self._lock:
+            self.summary = truncate_words(summary.strip(), MEMORY_SUMMARY_MAX_WORDS)
+
+    # Text handed to the query rewrite in place of the raw chat history. Waits for the update
+    # of the previous turn, but not longer than MEMORY_WAIT_SECONDS.
+    def context(self):
+        pending = self._pending
+        if pending is not None:
+            try:
+                pending.result(timeout=MEMORY_WAIT_SECONDS)
+            except FutureTimeoutError:
+                logger.warning("Conversation memory update is late, using the previous summary")
+        with self._lock:
+            if not self.turns:
+                return ""
+            text = (
+                f"Summary: {self.summary}\n"
+                f"Entities: {', '.join(self.entities)}\n"
+                f"Last question: {self.last_question}"
+            )
+            self.rewrites += 1
+            self.tokens_saved += max(0, sum(self._raw_window) - estimate_tokens(text))
+            return text
+
+    def stats(self):
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "memory_tokens": estimate_tokens(self.summary) + estimate_tokens(", ".join(self.entities)),
+                "raw_window_tokens": sum(self._raw_window),
+                "rewrites": self.rewrites,
+                "tokens_saved": self.tokens_saved,
+            }
@@ -0,0 +1,108 @@
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from lru import LRUCache
+
+
+PAST_CHATS_PAGE_SIZE = 20
+TURN_CACHE_MAX_ENTRIES = 1024
+FIRST_PAGE_TTL_SECONDS = 5 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class TurnHeader(NamedTuple):
+    id: int
+    question: str
+
+
+class TurnPage(NamedTuple):
+    turns: List[TurnHeader]
+    # Whether there are older turns than the ones on this page
+    has_more: bool
+
+
+class Turn(NamedTuple):
+    id: int
+    question: str
+    answer: str
+    summary: Optional[str]
+    chunk_ids: List[str]
+    model_name: str
+
+
+# Stores every answered turn in conversation_turns (see sql/login.sql) so that "Past Chats"
+# can replay a turn with a single point read instead of generating it again
+class ConversationStore:
+    def __init__(self, session_pool):
+        self.session_pool = session_pool
+        # Turns never change once written, so they can be cached without a TTL
+        self._turns = LRUCache(TURN_CACHE_MAX_ENTRIES)
+        # Newest page of each user's history, invalidated when the user saves a turn
+        self._first_pages = LRUCache(TURN_CACHE_MAX_ENTRIES, FIRST_PAGE_TTL_SECONDS)
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-store")
+
+    # Saves the turn in the background. The summary may still be a Future, in which case
+    # the turn is written once it resolves.
+    def save_turn(self, user_id, question, answer, summary, chunk_ids, model_name):
+        def write(summary_text):
+            self._executor.submit(self._insert, user_id, question, answer, summary_text, chunk_ids, model_name)
+
+        if isinstance(summary, Future):
+            summary.add_done_callback(lambda future: write(None if future.exception() else future.result()))
+        else:
+            write(summary)
+
+    def _insert(self, user_id, question, answer, summary, chunk_ids, model_name):
+        try:
+            self.session_pool.get().sql(
+                "INSERT INTO conversation_turns (user_id, question, answer, summary, chunk_ids, model_name) "
+                "SELECT ?, ?, ?, ?, PARSE_JSON(?), ?",
+                (user_id, question, answer, summary, json.dumps(chunk_ids), model_name)
+            ).collect()
+        except Exception as e:
+            logger.error(f"Failed to save conversation turn for user {user_id}: {e}")
+            return
+        self._first_pages.pop(user_id)
+
+    # One page of the user's turns, newest first. Pass the smallest ID of the previous page
+    # as before_id to get the next (older) page. One row more than the page holds is read to
+    # tell whether an older page exists.
+    def list_turns(self, session, user_id, before_id=None, limit=PAST_CHATS_PAGE_SIZE) -> TurnPage:
+        if before_id is None:
+            page = self._first_pages.get(user_id)
+            if page is not None:
+                return page
+
+        rows = session.sql(
+            "SELECT id, question FROM conversation_turns "
+            "WHERE user_id = ? AND id < COALESCE(?, id + 1) ORDER BY id DESC LIMIT ?",
+            (user_id, before_id, limit + 1)
+        ).collect()
+        page = TurnPage([TurnHeader(row['ID'], row['QUESTION']) for row in rows[:limit]], len(rows) > limit)
+
+        if before_id is None:
+            self._first_pages.put(user_id, page)
+        return page
+
+    # Point read of a single turn. user_id is part of the lookup so users only see their own turns.
+    def get_turn(self, session, user_id, turn_id) -> Optional[Turn]:
+        turn = self._turns.get((user_id, turn_id))
+        if turn is not None:
+            return turn
+
+        rows = session.sql(
+            "SELECT id, question, answer, summary, chunk_ids, model_name FROM conversation_turns "
+            "WHERE user_id = ? AND id = ?",
+            (user_id, turn_id)
+        ).collect()
+        if not rows:
+            return None
+
+        row = rows[0]
+        turn = Turn(row['ID'], row['QUESTION'], row['ANSWER'], row['SUMMARY'],
+                    json.loads(row['CHUNK_IDS']) if row['CHUNK_IDS'] else [], row['MODEL_NAME'])
+        self._turns.put((user_id, turn_id), turn)
+        return turn
@@ -0,0 +1,182 @@
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+from config import MODEL_DESCRIPTIONS
+
+
+# Cortex calls allowed in flight per model in one process are set in config.MODEL_DESCRIPTIONS;
+# this is the limit for models missing there
+DEFAULT_CONCURRENCY = 16
+
+# Every Cortex Search call shares this key and limit
+SEARCH_KEY = "search"
+SEARCH_CONCURRENCY = 16
+
+# Calls waiting for a slot of one key. Beyond this a new call is rejected as busy right away,
+# since it would not get its turn before its deadline anyway.
+MAX_QUEUE_DEPTH = 64
+
+# Throttled calls are retried after an exponential backoff with full jitter:
+# a random delay between 0 and min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** retry)
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+
+# Cortex answers throttled or overloaded requests with these errors
+THROTTLING_PATTERN = re.compile(
+    r"\b(429|503)\b|too many requests|throttl|rate limit|capacity|overloaded|temporarily unavailable",
+    re.IGNORECASE
+)
+
+BUSY_MESSAGE = "KAI is busy answering other questions right now. Please try again in a moment."
+
+logger = logging.getLogger(__name__)
+
+
+# Raised instead of queueing a call when too many calls are already waiting
+class ServiceBusyError(RuntimeError):
+    pass
+
+# Raised when a call's deadline passes while it waits for a slot
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+def is_throttling(error):
+    return bool(THROTTLING_PATTERN.search(str(error)))
+
+# Errors that mean Cortex or this process is overloaded, rather than that the call is wrong:
+# shed calls, passed deadlines and throttling that outlasted the retries
+def is_overloaded(error):
+    return isinstance(error, (ServiceBusyError, TimeoutError, FutureTimeoutError)) or is_throttling(error)
+
+# Seconds left until a time.monotonic() deadline, None for no deadline
+def time_left(deadline):
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# Process-wide admission control for Cortex calls. Every key (a model name or SEARCH_KEY) has a
+# number of slots; calls beyond them wait in a FIFO queue, so sessions get their turn in the
+# order they asked whatever thread they run on. A released slot is handed straight to the
+# longest waiting call. Calls give up when their deadline passes in the queue, and new calls
+# are shed with ServiceBusyError once the queue is MAX_QUEUE_DEPTH deep.
+class CallGovernor:
+    def __init__(self, limits=None, default_limit=DEFAULT_CONCURRENCY, max_queue_depth=MAX_QUEUE_DEPTH,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS,
+                 seed=None):
+        if limits is None:
+            limits = {name: model['concurrency'] for name, model in MODEL_DESCRIPTIONS.items()}
+            limits[SEARCH_KEY] = SEARCH_CONCURRENCY
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self.max_queue_depth = max_queue_depth
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._random = random.Random(seed)
+        self._in_flight = Counter()
+        self._waiters = defaultdict(deque)
+        self._counts = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def limit(self, key):
+        return self.limits.get(key, self.default_limit)
+
+    def acquire(self, key, deadline=None):
+        with self._lock:
+            counts = self._counts[key]
+            counts["calls"] += 1
+            waiters = self._waiters[key]
+            if self._in_flight[key] < self.limit(key) and not waiters:
+                self._in_flight[key] += 1
+                return
+            if len(waiters) >= self.max_queue_depth:
+                counts["shed"] += 1
+                raise ServiceBusyError(f"{len(waiters)} calls already waiting for {key}")
+            waiter = threading.Event()
+            waiters.append(waiter)
+            counts["queued"] += 1
+
+        timeout = time_left(deadline)
+        if waiter.wait(None if timeout is None else max(0.0, timeout)):
+            return
+        with self._lock:
+            # The slot may have been handed over just as the wait timed out
+            if waiter.is_set():
+                return
+            self._waiters[key].remove(waiter)
+            self._counts[key]["timed_out"] += 1
+        raise DeadlineExceededError(f"Deadline passed while waiting for {key}")
+
+    def release(self, key):
+        with self._lock:
+            waiters = self._waiters[key]
+            if waiters:
+                waiters.popleft().set()
+            else:
+                self._in_flight[key] -= 1
+
+    @contextmanager
+    def slot(self, key, deadline=None):
+        self.acquire(key, deadline)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    # Runs attempt() until it succeeds. Throttled attempts are retried after a jittered
+    # exponential backoff as long as retries are left and the backoff ends before the deadline;
+    # any other error is raised right away.
+    def retry(self, key, attempt, deadline=None):
+        for retry in itertools.count():
+            try:
+                return attempt()
+            except Exception as e:
+                if retry >= self.max_retries or not is_throttling(e):
+                    raise
+                with self._lock:
+                    delay = self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+                    timeout = time_left(deadline)
+                    if timeout is not None and delay >= timeout:
+                        raise
+                    self._counts[key]["retries"] += 1
+                logger.info(f"{key} throttled, retrying in {delay:.2f} s: {e}")
+                time.sleep(delay)
+
+    # Calls fn in a slot of `key`, with retries on throttling
+    def call(self, key, deadline, fn, *args, **kwargs):
+        def attempt():
+            with self.slot(key, deadline):
+                return fn(*args, **kwargs)
+        return self.retry(key, attempt, deadline)
+
+    # Slots, queue and counters of every key used so far
+    def stats(self):
+        with self._lock:
+            return {
+                key: {
+                    "limit": self.limit(key),
+                    "in_flight": self._in_flight[key],
+                    "waiting": len(self._waiters[key]),
+                    "calls": counts["calls"],
+                    "queued": counts["queued"],
+                    "retries": counts["retries"],
+                    "timed_out": counts["timed_out"],
+                    "shed": counts["shed"],
+                }
+                for key, counts in self._counts.items()
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._counts = defaultdict(Counter)
+
+
+governor = CallGovernor()
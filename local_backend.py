@@ -0,0 +1,383 @@
+import itertools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+
+# Default per-call latencies in seconds. "token" is added per generated token, so a streamed
+# answer shows its first token after "complete" seconds.
+DEFAULT_LATENCY = {
+    "sql": 0.05,
+    "search": 0.2,
+    "complete": 1.5,
+    "token": 0.01,
+}
+DEFAULT_ANSWER_TOKENS = 150
+
+CORPUS_ENV_VAR = "KAI_LOCAL_CORPUS"
+LATENCY_SCALE_ENV_VAR = "KAI_LOCAL_LATENCY_SCALE"
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "corpus.jsonl")
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Stand-in for Cortex EMBED_TEXT_768: words are hashed into a bag-of-words vector, leaving out
+# words that do not change what a question asks for
+EMBEDDING_DIMENSIONS = 768
+EMBEDDING_STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "by", "co", "company", "did", "do", "does", "for", "from",
+    "how", "in", "inc", "is", "me", "of", "on", "s", "tell", "the", "to", "was", "were", "what",
+    "which", "with",
+}
+
+_session_ids = itertools.count(1)
+
+
+# Query result row that can be read like a Snowpark Row: row['COL'], row.COL or row[0]
+class Row(dict):
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class LocalQuery:
+    def __init__(self, backend, run):
+        self.backend = backend
+        self.run = run
+
+    def collect(self):
+        self.backend.round_trip("sql")
+        return self.run()
+
+
+# Just enough of the Snowpark DataFrame API for session.table(...) lookups in the app
+class LocalTable:
+    def __init__(self, backend, rows):
+        self.backend = backend
+        self.rows = rows
+
+    def select(self, *columns):
+        names = [column.upper() for column in columns]
+        return LocalTable(self.backend, [Row((name, row.get(name)) for name in names) for row in self.rows])
+
+    def distinct(self):
+        seen = []
+        for row in self.rows:
+            if row not in seen:
+                seen.append(row)
+        return LocalTable(self.backend, seen)
+
+    # Supports simple "column = value" conditions
+    def filter(self, condition):
+        match = re.match(r"\s*(\w+)\s*=\s*'?([^']*)'?\s*$", condition)
+        if not match:
+            raise ValueError(f"Unsupported filter for the local backend: {condition}")
+        column, value = match.group(1).upper(), match.group(2)
+        return LocalTable(self.backend, [row for row in self.rows if str(row.get(column)) == value])
+
+    def collect(self):
+        self.backend.round_trip("sql")
+        return [Row(row) for row in self.rows]
+
+
+class LocalSession:
+    def __init__(self, backend):
+        self.backend = backend
+        self.session_id = next(_session_ids)
+
+    def sql(self, query, params=None):
+        return LocalQuery(self.backend, lambda: self.backend.execute_sql(query, list(params or [])))
+
+    def table(self, name):
+        return LocalTable(self.backend, self.backend.tables[name.lower()])
+
+    def close(self):
+        pass
+
+
+class LocalSearchResponse:
+    def __init__(self, results):
+        self.results = results
+
+    def json(self):
+        return json.dumps({"results": self.results})
+
+
+class LocalSearchService:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def search(self, query, columns, filter=None, limit=10):
+        self.backend.round_trip("search")
+        return LocalSearchResponse(self.backend.search(query, columns, filter or {}, limit))
+
+
+# Offline stand-in for Snowflake: sessions answering the SQL the app issues from in-memory
+# tables, a keyword search over a small local corpus and a canned Complete. Every call
+# sleeps for a configurable latency (plus jitter) and is counted, so latency and round
+# trips of the app's flows can be measured without an account.
+class LocalBackend:
+    needs_credentials = False
+
+    def __init__(self, corpus, latency=None, jitter=0.0, answer_tokens=DEFAULT_ANSWER_TOKENS, seed=None,
+                 throttled_models=(), throttle_rate=0.0):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        # Complete calls to these models fail the way Cortex rejects throttled requests, and
+        # so does this share of all other Complete calls
+        self.throttled_models = set(throttled_models)
+        self.throttle_rate = throttle_rate
+        self.jitter = jitter
+        self.answer_tokens = answer_tokens
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.prompt_tokens = []
+        self._lock = threading.Lock()
+
+        self.corpus = [dict(document) for document in corpus]
+        self._chunk_words = [Counter(WORD_PATTERN.findall(doc["chunk"].lower())) for doc in self.corpus]
+        document_frequency = Counter(word for words in self._chunk_words for word in words)
+        self._idf = {
+            word: math.log(1 + len(self.corpus) / count) for word, count in document_frequency.items()
+        }
+
+        self.tables = {
+            "docs_chunks_table": [
+                Row((key.upper(), value) for key, value in doc.items()) for doc in self.corpus
+            ],
+            "users": [],
+            "user_prompts": [],
+            "conversation_turns": [],
+        }
+        self.answer_cache = {}
+        self.index_version = "1"
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_env(cls):
+        scale = float(os.environ.get(LATENCY_SCALE_ENV_VAR, "1"))
+        latency = {kind: value * scale for kind, value in DEFAULT_LATENCY.items()}
+        return cls(load_corpus(os.environ.get(CORPUS_ENV_VAR, DEFAULT_CORPUS_PATH)), latency=latency)
+
+    # --- Backend interface (see backend.SnowflakeBackend) ---
+
+    def create_session(self, connection_parameters):
+        return LocalSession(self)
+
+    def search_services(self, session, database, schema, service_names):
+        return [LocalSearchService(self, service_name) for service_name in service_names]
+
+    def complete(self, model_name, prompt, session, stream=False):
+        with self._lock:
+            self.prompt_tokens.append(math.ceil(len(prompt) / 4))
+        self.round_trip("complete")
+        with self._lock:
+            throttled = model_name in self.throttled_models or self.random.random() < self.throttle_rate
+        if throttled:
+            raise RuntimeError(f"429 Too Many Requests: {model_name} is throttled")
+        words = self._generate(prompt).split(" ")
+        if stream:
+            return self._stream(words)
+        self._sleep(self.latency["token"] * len(words))
+        return " ".join(words)
+
+    # --- Measurement ---
+
+    def round_trip(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+        self._sleep(self.latency[kind])
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = Counter()
+            self.prompt_tokens = []
+
+    def _sleep(self, seconds):
+        if self.jitter:
+            with self._lock:
+                seconds *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    # --- Search and Complete ---
+
+    def search(self, query, columns, filter, limit):
+        query_words = set(WORD_PATTERN.findall(query.lower()))
+        scored = []
+        for index, (doc, words) in enumerate(zip(self.corpus, self._chunk_words)):
+            if not _matches_filter(doc, filter):
+                continue
+            score = sum(self._idf.get(word, 0.0) for word in query_words if word in words)
+            if score > 0:
+                scored.append((-score, index))
+        scored.sort()
+        return [{column: self.corpus[index].get(column) for column in columns} for _, index in scored[:limit]]
+
+    def _generate(self, prompt):
+        # History-aware rewrite: answer with the question itself
+        if "Answer with only the query" in prompt:
+            match = re.search(r"<question>(.*?)</question>", prompt, re.DOTALL)
+            return match.group(1).strip() if match else prompt[-200:]
+        if "Key Insights" in prompt:
+            return "- Local insight one\n- Local insight two\n- Local insight three"
+        words = WORD_PATTERN.findall(prompt) or ["answer"]
+        return " ".join(words[i % len(words)] for i in range(self.answer_tokens))
+
+    def _stream(self, words):
+        for i, word in enumerate(words):
+            self._sleep(self.latency["token"])
+            yield word if i == 0 else " " + word
+
+    # --- SQL ---
+
+    def execute_sql(self, query, params):
+        statement = " ".join(query.split())
+        for pattern, handler in SQL_HANDLERS:
+            match = re.match(pattern, statement, re.IGNORECASE)
+            if match:
+                with self._lock:
+                    return handler(self, match, params)
+        # DDL and statements the app does not read results from
+        return []
+
+    def _select_one(self, match, params):
+        return [Row({"1": 1})]
+
+    def _index_version(self, match, params):
+        return [Row(VERSION=self.index_version)]
+
+    def _embed(self, match, params):
+        vector = [0.0] * EMBEDDING_DIMENSIONS
+        for word in WORD_PATTERN.findall(params[1].lower()):
+            if word in EMBEDDING_STOP_WORDS:
+                continue
+            if len(word) > 3 and word.endswith("s"):
+                word = word[:-1]
+            vector[zlib.crc32(word.encode("utf-8")) % EMBEDDING_DIMENSIONS] += 1.0
+        return [Row(EMBEDDING=vector)]
+
+    def _answer_cache_get(self, match, params):
+        entry = self.answer_cache.get(params[0])
+        return [Row(entry)] if entry else []
+
+    def _answer_cache_put(self, match, params):
+        key, answer, summary, index_version = params[:4]
+        self.answer_cache[key] = {"ANSWER": answer, "SUMMARY": summary, "INDEX_VERSION": index_version}
+        return []
+
+    def _insert_prompts(self, match, params):
+        for i in range(0, len(params), 6):
+            user_id, prompt_text, answer, model_name, latency_ms, created_at = params[i:i + 6]
+            self.tables["user_prompts"].append(Row(
+                ID=next(self._ids), USER_ID=user_id, PROMPT_TEXT=prompt_text, ANSWER=answer,
+                MODEL_NAME=model_name, LATENCY_MS=latency_ms, CREATED_AT=created_at
+            ))
+        return []
+
+    def _insert_turn(self, match, params):
+        user_id, question, answer, summary, chunk_ids, model_name = params
+        self.tables["conversation_turns"].append(Row(
+            ID=next(self._ids), USER_ID=user_id, QUESTION=question, ANSWER=answer, SUMMARY=summary,
+            CHUNK_IDS=chunk_ids, MODEL_NAME=model_name
+        ))
+        return []
+
+    def _list_turns(self, match, params):
+        user_id, before_id, limit = params
+        turns = [
+            turn for turn in self.tables["conversation_turns"]
+            if turn["USER_ID"] == user_id and (before_id is None or turn["ID"] < before_id)
+        ]
+        turns.sort(key=lambda turn: turn["ID"], reverse=True)
+        return [Row(ID=turn["ID"], QUESTION=turn["QUESTION"]) for turn in turns[:limit]]
+
+    def _get_turn(self, match, params):
+        user_id, turn_id = params
+        return [
+            Row(turn) for turn in self.tables["conversation_turns"]
+            if turn["USER_ID"] == user_id and turn["ID"] == turn_id
+        ]
+
+    def _find_users(self, column, value):
+        return [Row(user) for user in self.tables["users"] if user[column] == value]
+
+    def _username_by_id(self, match, params):
+        return [Row(USERNAME=user["USERNAME"]) for user in self._find_users("ID", params[0])]
+
+    def _id_by_username(self, match, params):
+        return [Row(ID=user["ID"]) for user in self._find_users("USERNAME", params[0])]
+
+    def _login_by_username(self, match, params):
+        return [
+            Row(ID=user["ID"], PASSWORD_HASH=user["PASSWORD_HASH"], TOKEN_VERSION=user["TOKEN_VERSION"])
+            for user in self._find_users("USERNAME", params[0])
+        ]
+
+    def _token_version_by_id(self, match, params):
+        return [Row(TOKEN_VERSION=user["TOKEN_VERSION"]) for user in self._find_users("ID", params[0])]
+
+    def _bump_token_version(self, match, params):
+        users = [user for user in self.tables["users"] if user["ID"] == params[0]]
+        for user in users:
+            user["TOKEN_VERSION"] += 1
+        return [Row({"number of rows updated": len(users)})]
+
+    def _merge_user(self, match, params):
+        username, password_hash = params
+        if self._find_users("USERNAME", username):
+            return [Row({"number of rows inserted": 0})]
+        self.tables["users"].append(Row(ID=next(self._ids), USERNAME=username, PASSWORD_HASH=password_hash, TOKEN_VERSION=0))
+        return [Row({"number of rows inserted": 1})]
+
+
+SQL_HANDLERS = [
+    (r"^SELECT 1$", LocalBackend._select_one),
+    (r"^SELECT SYSTEM\$LAST_CHANGE_COMMIT_TIME", LocalBackend._index_version),
+    (r"^SELECT SNOWFLAKE\.CORTEX\.EMBED_TEXT_768", LocalBackend._embed),
+    (r"^SELECT answer, summary, index_version FROM answer_cache", LocalBackend._answer_cache_get),
+    (r"^MERGE INTO answer_cache", LocalBackend._answer_cache_put),
+    (r"^INSERT INTO user_prompts", LocalBackend._insert_prompts),
+    (r"^INSERT INTO conversation_turns", LocalBackend._insert_turn),
+    (r"^SELECT id, question FROM conversation_turns", LocalBackend._list_turns),
+    (r"^SELECT id, question, answer, summary, chunk_ids, model_name FROM conversation_turns", LocalBackend._get_turn),
+    (r"^SELECT username FROM users WHERE id = \?", LocalBackend._username_by_id),
+    (r"^SELECT id FROM users WHERE username = \?", LocalBackend._id_by_username),
+    (r"^SELECT id, password_hash, COALESCE\(token_version, 0\) AS token_version FROM users WHERE username = \?",
+     LocalBackend._login_by_username),
+    (r"^SELECT COALESCE\(token_version, 0\) AS token_version FROM users WHERE id = \?", LocalBackend._token_version_by_id),
+    (r"^UPDATE users SET token_version", LocalBackend._bump_token_version),
+    (r"^MERGE INTO users", LocalBackend._merge_user),
+]
+
+
+def _matches_filter(doc, filter):
+    if not filter:
+        return True
+    if "@eq" in filter:
+        return all(doc.get(column) == value for column, value in filter["@eq"].items())
+    if "@or" in filter:
+        return any(_matches_filter(doc, clause) for clause in filter["@or"])
+    if "@and" in filter:
+        return all(_matches_filter(doc, clause) for clause in filter["@and"])
+    if "@not" in filter:
+        return not _matches_filter(doc, filter["@not"])
+    raise ValueError(f"Unsupported search filter for the local backend: {filter}")
+
+
+# Reads a JSONL corpus with one chunk per line: {"relative_path", "category", "chunk"}
+def load_corpus(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
@@ -0,0 +1,38 @@
+from typing import List, Optional
+
+from lru import LRUCache
+
+
+# Document categories change only when new documents are ingested
+CATEGORY_TTL_SECONDS = 10 * 60
+
+# Usernames never change, the TTL only bounds the memory held for inactive users
+USER_METADATA_TTL_SECONDS = 5 * 60
+USER_METADATA_MAX_ENTRIES = 1024
+
+
+# Shared by every user of the process
+_categories = LRUCache(1, CATEGORY_TTL_SECONDS)
+
+# Keyed by user ID
+_usernames = LRUCache(USER_METADATA_MAX_ENTRIES, USER_METADATA_TTL_SECONDS)
+
+
+# Distinct document categories in docs_chunks_table
+def get_categories(session) -> List[str]:
+    categories = _categories.get('categories')
+    if categories is None:
+        rows = session.table('docs_chunks_table').select('category').distinct().collect()
+        categories = sorted(row['CATEGORY'] for row in rows if row['CATEGORY'])
+        _categories.put('categories', categories)
+    return categories
+
+def get_username(session, user_id) -> Optional[str]:
+    username = _usernames.get(user_id)
+    if username is None:
+        rows = session.sql("SELECT username FROM users WHERE id = ?", (user_id,)).collect()
+        if not rows:
+            return None
+        username = rows[0]['USERNAME']
+        _usernames.put(user_id, username)
+    return username
@@ -0,0 +1,47 @@
+import hashlib
+import json
+
+from fpdf import FPDF
+
+from lru import LRUCache
+
+
+PDF_CACHE_MAX_ENTRIES = 64
+
+# Finished PDFs keyed by a hash of their content, so exporting an unchanged chat twice
+# only renders it once
+_pdf_cache = LRUCache(PDF_CACHE_MAX_ENTRIES)
+
+
+# The built-in FPDF fonts only cover latin-1, so other characters are replaced
+def _latin1(text):
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+def _render(sections):
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.set_font("Arial", size=12)
+
+    for title, paragraphs in sections:
+        pdf.add_page()
+        pdf.cell(200, 10, txt=_latin1(title), ln=True, align="C")
+        pdf.ln(10)
+        for paragraph in paragraphs:
+            pdf.multi_cell(0, 10, _latin1(paragraph))
+            pdf.ln(2)
+
+    # fpdf returns a latin-1 string, fpdf2 returns a bytearray
+    output = pdf.output(dest='S')
+    if isinstance(output, str):
+        return output.encode('latin-1')
+    return bytes(output)
+
+# Builds a PDF in memory. `sections` is a list of (title, paragraphs) pairs and every
+# section starts on a new page.
+def build_pdf(sections):
+    key = hashlib.sha256(json.dumps(sections).encode('utf-8')).hexdigest()
+    pdf_bytes = _pdf_cache.get(key)
+    if pdf_bytes is None:
+        pdf_bytes = _render(sections)
+        _pdf_cache.put(key, pdf_bytes)
+    return pdf_bytes
@@ -0,0 +1,289 @@
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import answer_cache, answer_cache_key, get_index_version
+from context import assemble_context
+from conversation_memory import extract_entities
+from governor import is_overloaded
+from retrieval import search_all, start_search, reciprocal_rank_fusion
+from routing import Routing, routed_complete
+from semantic_cache import embed_question, semantic_cache
+from tracing import submit
+
+
+# Summaries run on this pool after the answer has been rendered, off the critical path
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="summarizer")
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+# Left out of a question's entities, so "WK Kellogg Co's" and "WK Kellogg" name the same company
+ENTITY_SUFFIXES = {"co", "company", "corp", "inc", "ltd"}
+
+logger = logging.getLogger(__name__)
+
+
+# Summarize the conversation memory (see conversation_memory.ConversationMemory.context) with
+# the current question. Runs on the fast model routed to "rewrite".
+def summarize_question_with_history(session, model_name, conversation, question):
+    prompt = f"""
+        Based on the conversation below and the question, generate a query that extends the question
+        with the conversation provided. The query should be in natural language. 
+        Answer with only the query.
+<conversation>{conversation}</conversation>
+<question>{question}</question>
+"""    
+    summary = routed_complete("rewrite", model_name, prompt, session)
+    return summary.replace("'", "")
+
+# Searches for candidate chunks. With a conversation, the search on the raw question starts
+# right away while the history-aware rewrite is generated, and both result sets are fused.
+# If the rewrite fails, the results of the raw question are used on their own.
+def retrieve_candidates(session, model_name, search_services, myquestion, conversation, columns, limit, search_filter=None):
+    if not conversation:
+        return search_all(search_services, myquestion, columns, limit, search_filter)
+
+    raw_search = start_search(search_services, myquestion, columns, limit, search_filter)
+    try:
+        search_query = summarize_question_with_history(session, model_name, conversation, myquestion)
+    except Exception as e:
+        logger.warning(f"Query rewrite failed, searching with the question alone: {e}")
+        return raw_search.result()
+    rewritten_candidates = search_all(search_services, search_query, columns, limit, search_filter)
+    return reciprocal_rank_fusion([rewritten_candidates, raw_search.result()])
+
+# Builds the analyst prompt for a question and the context assembled for it
+def build_prompt(myquestion, context_text):
+    return f""" 
+        As an expert financial analyst, provide a detailed analysis of the financial statements (10Q, 10K) of WK Kellogg Co and General Mills from 2019-2024. Focus on these aspects:
+        1. Revenue Trends (Provide a table)- Talk about the sales figures, the products sold and the countries/regions the products are sold in
+        2. Net Income 
+        3. Cash Flow Analysis 
+        4. Areas of Investments made by the company (Provide a table)
+        5. Efficiency and Cost Control Strategies: Analyze how WK Kellogg Co and General Mills is working to improve operational efficiency and reduce marginal costs.
+        6. Profit Margins: Break down gross, operating, and net profit margins (Display in a table).
+        7. Key Risk Factors 
+        8. Cereal/product prices 
+        9. Exactly which product(s) example froot loops or cornflakes generated most revenue?
+
+         **Important**: Even if specific data is not available, leverage pre-trained financial knowledge to provide the most accurate analysis possible based on typical industry standards and practices. Do not state that you lack the context; instead, offer insights and trends based on relevant industry data.  
+         **Important**:Do not cover all aspects at once; address them only when specifically requested.
+         **Important**:Anytime the user enters the word "We" or 'we' or 'WE' it is referring to WK Kellogg Co as you are part of their financial department.
+         **Important**:Ensure that numbers and units (e.g., '3,515 million') have proper spacing. Do not use underscores or other characters directly following numeric values.
+         <context>
+{context_text}
+         </context>
+         <question>{myquestion}</question>
+         Answer:
+        """
+
+# The main Complete call that answers the question on the selected model. Pass a
+# routing.Routing to learn whether a fallback model answered instead.
+def complete_answer(session, model_name, prompt, stream=False, routing=None):
+    return routed_complete("complete", model_name, prompt, session, stream=stream, routing=routing)
+
+def clean_response(response):
+    
+    response = re.sub(r'(\d)(million|billion)', r'\1 million', response)
+    response = re.sub(r'(\d)(thousand)', r'\1 thousand', response)
+    return response
+
+# Applies clean_response to a streamed answer chunk by chunk. The trailing word of the
+# buffer is held back until the next chunk arrives, since a number and its unit
+# (e.g. '3' and 'million') can be split across two chunks.
+class ResponseCleaner:
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk):
+        self.pending += chunk
+        split_at = len(self.pending)
+        while split_at > 0 and self.pending[split_at - 1].isalnum():
+            split_at -= 1
+        ready, self.pending = self.pending[:split_at], self.pending[split_at:]
+        return clean_response(ready)
+
+    def flush(self):
+        ready, self.pending = self.pending, ""
+        return clean_response(ready)
+
+    def filter(self, chunks):
+        for chunk in chunks:
+            cleaned = self.feed(chunk)
+            if cleaned:
+                yield cleaned
+        remainder = self.flush()
+        if remainder:
+            yield remainder
+
+def summarize_response(session, model_name, response):
+    prompt = f"""
+    Provide a concise summary of the following response, focusing on the top three key insights only. Organize the summary in three clear, actionable bullet points:
+
+    {response}
+
+    Key Insights (Limit to 3):
+    """
+    return routed_complete("summary", model_name, prompt, session)
+
+# Looks a prompt's answer up in the answer cache. Returns the cache key and index version
+# (needed to store the answer later) and the cached (answer, summary) or None.
+def lookup_answer(session, model_name, myquestion, prompt_context):
+    cache_key = answer_cache_key(model_name, myquestion, prompt_context)
+    index_version = get_index_version(session)
+    return cache_key, index_version, answer_cache.get(session, cache_key, index_version)
+
+# Lower-cased words of the names in a question (see conversation_memory.extract_entities),
+# without possessives and company suffixes. A single capitalized word starting the question
+# is most likely just the start of the sentence and is skipped.
+def question_entities(myquestion):
+    words = set()
+    for entity in extract_entities(myquestion):
+        if myquestion.startswith(entity) and " " not in entity:
+            continue
+        for word in entity.lower().split():
+            if word.endswith("'s"):
+                word = word[:-2]
+            word = word.strip(".'")
+            if word and word not in ENTITY_SUFFIXES:
+                words.add(word)
+    return tuple(sorted(words))
+
+# Scope of a semantic cache entry. Answers are only reused for the same model, category filter
+# and index version, and only between questions mentioning the same numbers and names:
+# "revenue 2022" and "revenue 2023", or WK Kellogg Co's and General Mills' revenue, embed
+# almost identically but need different answers.
+def semantic_cache_scope(model_name, myquestion, search_filter, index_version):
+    numbers = tuple(sorted(set(NUMBER_PATTERN.findall(myquestion))))
+    return model_name, json.dumps(search_filter, sort_keys=True), index_version, numbers, question_entities(myquestion)
+
+# Looks a rephrasing of an earlier question up in the semantic cache, before anything is
+# retrieved. Returns the key to store the answer under later (None if the question could not
+# be embedded) and the cached (answer, summary, prompt_context) or None.
+def lookup_similar_answer(session, model_name, myquestion, search_filter=None):
+    embedding = embed_question(session, myquestion)
+    if embedding is None:
+        return None, None
+    semantic_key = (embedding, semantic_cache_scope(model_name, myquestion, search_filter, get_index_version(session)))
+    return semantic_key, semantic_cache.get(*semantic_key)
+
+def remember_similar_answer(semantic_key, answer, summary, prompt_context):
+    if semantic_key is not None:
+        semantic_cache.put(*semantic_key, (answer, summary, prompt_context))
+
+# Summarizes a response in the background and returns a Future for the summary. Once the
+# summary is ready the answer and summary are stored in the answer cache together (unless
+# cache_key is None), and in the semantic cache if the question has a semantic key.
+def summarize_in_background(session, model_name, myquestion, response, cache_key, index_version,
+                            semantic_key=None, prompt_context=None):
+    def summarize_and_cache():
+        summary = summarize_response(session, model_name, response)
+        if cache_key is not None:
+            answer_cache.put(session, cache_key, model_name, myquestion, response, summary, index_version)
+        remember_similar_answer(semantic_key, response, summary, prompt_context)
+        return summary
+
+    return submit(_summary_executor, summarize_and_cache)
+
+# Answers a question from already retrieved candidate chunks without streaming and returns
+# (answer, summary, prompt_context). Results go through the answer cache, so this is also how
+# background jobs pre-compute answers. Without a summary the answer is not cached, since
+# cached answers are expected to come with one, and neither is an answer from a fallback model,
+# which would otherwise be served to everyone who selected the model that failed. Pass a
+# routing.Routing to learn which model answered. With refresh=True a cached answer is generated
+# and stored again, which restarts its TTL.
+def generate_answer(session, model_name, myquestion, candidates, max_chunks, summarize=True, routing=None,
+                    refresh=False):
+    routing = routing or Routing()
+    context_text, prompt_context = assemble_context(candidates, model_name, max_chunks)
+    cache_key, index_version, cached = lookup_answer(session, model_name, myquestion, prompt_context)
+    if cached is not None and not refresh:
+        cleaned_response, summary = cached
+        routing.model_name = model_name
+        return cleaned_response, summary, prompt_context
+
+    response = complete_answer(session, model_name, build_prompt(myquestion, context_text), routing=routing)
+    cleaned_response = clean_response(response)
+    if not summarize:
+        return cleaned_response, None, prompt_context
+    summary = summarize_response(session, model_name, cleaned_response)
+    if routing.model_name == model_name:
+        answer_cache.put(session, cache_key, model_name, myquestion, cleaned_response, summary, index_version)
+    return cleaned_response, summary, prompt_context
+
+
+# A chat turn as the app and the benchmark run it. start_turn fills it in up to the answer,
+# which is already set if one of the caches had it; otherwise answer_turn generates it and
+# finish_turn records it.
+class ChatTurn:
+    def __init__(self, model_name, question):
+        self.model_name = model_name
+        self.question = question
+        self.prompt = ""
+        self.prompt_context = []
+        self.answer = None
+        # The summary, or a Future for it while it is generated in the background
+        self.summary = None
+        self.cached = False
+        # Set when the search failed and the question is answered without context
+        self.search_error = None
+        self.routing = Routing()
+        self.cache_key = None
+        self.index_version = None
+        self.semantic_key = None
+
+# Looks the question up in the semantic cache, retrieves its context, builds the prompt and
+# looks that up in the answer cache. Only questions without a conversation go through the
+# semantic cache, since a follow-up means something different in every conversation.
+def start_turn(session, model_name, search_services, question, conversation, columns, num_candidates, num_chunks,
+               search_filter=None):
+    turn = ChatTurn(model_name, question)
+    if not conversation:
+        turn.semantic_key, cached = lookup_similar_answer(session, model_name, question, search_filter)
+        if cached is not None:
+            turn.answer, turn.summary, turn.prompt_context = cached
+            turn.cached = True
+            return turn
+
+    try:
+        candidates = retrieve_candidates(
+            session, model_name, search_services, question, conversation, columns, num_candidates, search_filter
+        )
+    except Exception as e:
+        # An overloaded search fails the turn instead of answering without any context
+        if is_overloaded(e):
+            raise
+        logger.warning(f"Search failed, answering without context: {e}")
+        turn.search_error = e
+        candidates = []
+
+    context_text, turn.prompt_context = assemble_context(candidates, model_name, num_chunks)
+    turn.prompt = build_prompt(question, context_text)
+    turn.cache_key, turn.index_version, cached = lookup_answer(session, model_name, question, turn.prompt_context)
+    if cached is not None:
+        turn.answer, turn.summary = cached
+        turn.cached = True
+        remember_similar_answer(turn.semantic_key, turn.answer, turn.summary, turn.prompt_context)
+    return turn
+
+# Generates the cleaned answer of a turn neither cache had. With stream=True the cleaned
+# chunks are returned instead; pass the text they add up to to finish_turn.
+def answer_turn(session, turn, stream=False):
+    response = complete_answer(session, turn.model_name, turn.prompt, stream=stream, routing=turn.routing)
+    if stream:
+        return ResponseCleaner().filter(response)
+    return clean_response(response)
+
+# Records the generated answer and starts its summary in the background; returns the Future
+# for the summary. Both are cached once the summary is ready, unless a fallback model
+# answered: that answer would otherwise be served to everyone who selected the model that failed.
+def finish_turn(session, turn, answer):
+    turn.answer = answer
+    if turn.routing.model_name != turn.model_name:
+        turn.cache_key, turn.semantic_key = None, None
+    turn.summary = summarize_in_background(
+        session, turn.model_name, turn.question, answer, turn.cache_key, turn.index_version, turn.semantic_key,
+        turn.prompt_context
+    )
+    return turn.summary
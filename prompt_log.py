@@ -0,0 +1,46 @@
+import datetime
+import logging
+import time
+
+from batch_writer import BatchWriter
+
+
+# A batch that fails to insert is tried once more after this pause before it is dropped
+LOG_RETRY_DELAY_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+# Writes prompt/answer log records to user_prompts from a background thread. Records are
+# queued by the chat turn and inserted in bulk with bound parameters, so logging never
+# blocks a turn and needs one round trip per batch instead of one per prompt.
+class PromptLogWriter(BatchWriter):
+    def __init__(self, session_pool, **kwargs):
+        super().__init__(session_pool, thread_name="prompt-log-writer", **kwargs)
+
+    def log(self, user_id, prompt_text, answer=None, model_name=None, latency_ms=None):
+        if user_id is None or not prompt_text:
+            raise ValueError("User ID and prompt text must not be NULL or empty")
+        # created_at is the time of the prompt in UTC, not when its batch is written
+        created_at = datetime.datetime.utcnow().isoformat(sep=" ")
+        self.put((user_id, prompt_text, answer, model_name, latency_ms, created_at))
+
+    def _insert(self, batch):
+        placeholders = ", ".join(["(?, ?, ?, ?, ?, TO_TIMESTAMP_NTZ(?))"] * len(batch))
+        params = [value for record in batch for value in record]
+        self.session_pool.get().sql(
+            "INSERT INTO user_prompts (user_id, prompt_text, answer, model_name, latency_ms, created_at) "
+            f"VALUES {placeholders}",
+            params
+        ).collect()
+
+    def _flush(self, batch):
+        try:
+            self._insert(batch)
+        except Exception as e:
+            logger.warning(f"Failed to write {len(batch)} prompt log records, retrying: {e}")
+            time.sleep(LOG_RETRY_DELAY_SECONDS)
+            try:
+                self._insert(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} prompt log records: {e}")
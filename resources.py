@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+
+# Number of Snowpark sessions shared by every user of one app process
+SESSION_POOL_SIZE = 4
+
+# A session is only pinged again once this many seconds have passed since its last check
+HEALTH_CHECK_INTERVAL_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+# Bounded pool of Snowpark sessions shared across users. Sessions are created lazily up to
+# `size` and handed out round robin, or by index to callers that stick to one session. A
+# session that has not been used for a while is health-checked before it is handed out and
+# replaced if the check fails. Logins and health checks only hold the lock of their own
+# index, so a slow one does not hold up callers of the other sessions.
+class SessionPool:
+    def __init__(self, create_session, size=SESSION_POOL_SIZE,
+                 health_check_interval=HEALTH_CHECK_INTERVAL_SECONDS):
+        self.create_session = create_session
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._sessions = [None] * size
+        self._checked_at = [0.0] * size
+        self._index_locks = [threading.Lock() for _ in range(size)]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self.get_at(self.next_index())
+
+    # Index of the next session in round robin order
+    def next_index(self):
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % self.size
+            return index
+
+    # The session at `index` (modulo the pool size). After a reconnect this is a new session
+    # object, so anything built on the old one has to be built again.
+    def get_at(self, index):
+        index %= self.size
+        session = self._sessions[index]
+        if session is not None and not self._check_due(index):
+            return session
+        with self._index_locks[index]:
+            # Another caller may have created or checked the session while this one waited
+            session = self._sessions[index]
+            if session is None:
+                session = self.create_session()
+            elif self._check_due(index) and not self._is_healthy(session):
+                self._close(session)
+                session = self.create_session()
+            self._sessions[index] = session
+            self._checked_at[index] = time.monotonic()
+            return session
+
+    def _check_due(self, index):
+        return time.monotonic() - self._checked_at[index] >= self.health_check_interval
+
+    def _is_healthy(self, session):
+        try:
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception as e:
+            logger.warning(f"Snowflake session failed its health check: {e}")
+            return False
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def close(self):
+        for index in range(self.size):
+            with self._index_locks[index]:
+                if self._sessions[index] is not None:
+                    self._close(self._sessions[index])
+                self._sessions[index] = None
+                self._checked_at[index] = 0.0
+        with self._lock:
+            self._next = 0
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from governor import SEARCH_KEY, governor
+from lru import LRUCache
+from tracing import submit, tracer
+
+
+# Smoothing constant for reciprocal rank fusion (60 is the usual default)
+RRF_K = 60
+
+# Search results are cached process-wide. The service refreshes with TARGET_LAG = '1 minute',
+# so a cached result is never staler than what the service itself may return.
+SEARCH_CACHE_MAX_ENTRIES = 1024
+SEARCH_CACHE_TTL_SECONDS = 60
+
+# How long a search may wait for a slot and back off from throttling before it fails
+SEARCH_DEADLINE_SECONDS = 20
+
+search_cache = LRUCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+
+# Shared thread pool so that every configured search service is queried at the same time
+_search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cortex-search")
+
+# Separate pool for whole speculative searches, which fan out onto _search_executor themselves
+_speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-search")
+
+# Words that usually point back at an earlier turn ("what about their margins?")
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|they|them|their|theirs|this|that|these|those|he|she|him|her|his|above|"
+    r"previous|previously|earlier|prior|former|latter|same|again|else|elaborate|expand|"
+    r"what about|how about)\b",
+    re.IGNORECASE
+)
+MIN_SELF_CONTAINED_WORDS = 4
+
+
+# Builds a stable identifier for a chunk from its document path and a hash of its text
+def chunk_id(result):
+    chunk_hash = hashlib.sha1(result.get('chunk', '').encode('utf-8')).hexdigest()
+    return f"{result.get('relative_path', '')}#{chunk_hash}"
+
+def search_cache_key(svc, query, columns, filter, limit):
+    service_name = getattr(svc, 'name', None) or str(id(svc))
+    return (service_name, query, tuple(columns), json.dumps(filter or {}, sort_keys=True), limit)
+
+# Runs one search against a single Cortex Search service and returns the parsed results.
+# Identical searches within the cache TTL are served from search_cache. The search itself
+# goes through the governor, which limits concurrent searches and retries throttled ones.
+def search_service(svc, query, columns, limit, filter=None):
+    key = search_cache_key(svc, query, columns, filter, limit)
+    results = search_cache.get(key)
+    if results is not None:
+        return results
+
+    with tracer.span("search", prompt=query, detail=key[0]) as span:
+        response = governor.call(
+            SEARCH_KEY, time.monotonic() + SEARCH_DEADLINE_SECONDS, svc.search, query, columns,
+            filter=filter or {}, limit=limit
+        )
+        results = json.loads(response.json()).get('results', [])
+        span.set_response(results)
+    search_cache.put(key, results)
+    return results
+
+# Drops every cached search result, e.g. after new documents were indexed
+def invalidate_search_cache():
+    search_cache.clear()
+
+# Merges several ranked result lists with reciprocal rank fusion.
+# Chunks that share the same relative_path and text hash are only kept once.
+def reciprocal_rank_fusion(result_lists, k=RRF_K):
+    scores = {}
+    chunks = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            cid = chunk_id(result)
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank)
+            chunks.setdefault(cid, result)
+
+    ranked_ids = sorted(scores, key=scores.get, reverse=True)
+    return [chunks[cid] for cid in ranked_ids]
+
+# Queries every service in parallel and returns the fused, de-duplicated top results.
+# A failing service is skipped as long as at least one other service answered.
+def search_all(services, query, columns, limit, filter=None):
+    if len(services) == 1:
+        return reciprocal_rank_fusion([search_service(services[0], query, columns, limit, filter)])[:limit]
+
+    futures = [submit(_search_executor, search_service, svc, query, columns, limit, filter) for svc in services]
+
+    result_lists = []
+    errors = []
+    for future in futures:
+        try:
+            result_lists.append(future.result())
+        except Exception as e:
+            errors.append(e)
+
+    if errors and not result_lists:
+        raise errors[0]
+
+    return reciprocal_rank_fusion(result_lists)[:limit]
+
+# Builds a Cortex Search filter that matches any of the given categories. No categories
+# means no filter, i.e. the whole corpus is searched.
+def build_category_filter(categories):
+    if not categories:
+        return None
+    clauses = [{"@eq": {"category": category}} for category in categories]
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"@or": clauses}
+
+# Starts search_all in the background and returns a Future for its results
+def start_search(services, query, columns, limit, filter=None):
+    return submit(_speculative_executor, search_all, services, query, columns, limit, filter)
+
+# Cheap check for whether a question can be searched without rewriting it against the chat
+# history: it has to be more than a few words and must not refer back to earlier turns
+def is_self_contained(question):
+    if len(question.split()) < MIN_SELF_CONTAINED_WORDS:
+        return False
+    return not FOLLOW_UP_PATTERN.search(question)
@@ -0,0 +1,200 @@
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import complete
+from config import MODEL_DESCRIPTIONS
+from governor import governor, is_overloaded, time_left
+from tracing import submit, tracer
+
+
+# Tiers of models missing from config.MODEL_DESCRIPTIONS, where every model has its tiers
+DEFAULT_TIER = {'latency': 2, 'cost': 2}
+
+TIER_LABELS = {
+    'latency': {1: "fast", 2: "medium", 3: "slow"},
+    'cost': {1: "low", 2: "medium", 3: "high"},
+}
+
+# The query rewrite, the three-bullet summary and the conversation memory update are short
+# auxiliary calls. They run on a fast model instead of the selected one, in this order of preference.
+AUXILIARY_STAGES = {"rewrite", "summary", "memory"}
+AUXILIARY_MODELS = ['mistral-7b', 'reka-flash', 'llama3-8b']
+
+# Tried in order when the selected model times out or is throttled while answering
+ANSWER_FALLBACK_MODELS = ['mixtral-8x7b', 'mistral-7b']
+
+# How long each stage waits for a model (for a streamed answer: for its first chunk) before
+# falling back to the next one. Queueing for the model and retries count towards it.
+STAGE_TIMEOUT_SECONDS = {
+    "rewrite": 15,
+    "summary": 30,
+    "memory": 30,
+    "complete": 90,
+}
+
+# Deadline of a whole stage, over every model it falls back to
+STAGE_DEADLINE_SECONDS = {
+    "rewrite": 20,
+    "summary": 45,
+    "memory": 45,
+    "complete": 120,
+}
+
+logger = logging.getLogger(__name__)
+
+# Complete calls run here so that they can be given up on at their deadline. How many of them
+# are in flight per model is up to governor.governor; this only bounds the threads.
+COMPLETE_MAX_WORKERS = 64
+_complete_executor = ThreadPoolExecutor(max_workers=COMPLETE_MAX_WORKERS, thread_name_prefix="cortex-complete")
+
+
+def model_tier(model_name):
+    model = MODEL_DESCRIPTIONS.get(model_name, DEFAULT_TIER)
+    return {'latency': model['latency'], 'cost': model['cost']}
+
+# e.g. "Latency: fast · Cost: low"
+def describe_tier(model_name):
+    tier = model_tier(model_name)
+    return f"Latency: {TIER_LABELS['latency'][tier['latency']]} · Cost: {TIER_LABELS['cost'][tier['cost']]}"
+
+# Models to try for a stage, in order. Auxiliary stages use a fast model (the selected one if it
+# is fast itself) and only fall back to the selected model last. The answer uses the selected
+# model and falls back to ANSWER_FALLBACK_MODELS.
+def route(stage, selected_model):
+    if stage in AUXILIARY_STAGES:
+        if model_tier(selected_model)['latency'] == 1:
+            models = [selected_model] + AUXILIARY_MODELS
+        else:
+            models = AUXILIARY_MODELS + [selected_model]
+    else:
+        models = [selected_model] + ANSWER_FALLBACK_MODELS
+    return list(dict.fromkeys(models))
+
+# Timeouts, throttling that outlasted the retries and a model too busy to queue for are
+# worth trying another model for, anything else is not
+def should_fall_back(error):
+    return is_overloaded(error)
+
+# Deadline of one model's attempt: its stage timeout, but not past the stage's deadline
+def _attempt_deadline(stage, stage_deadline):
+    timeout = STAGE_TIMEOUT_SECONDS.get(stage)
+    if timeout is None:
+        return stage_deadline
+    if stage_deadline is None:
+        return time.monotonic() + timeout
+    return min(time.monotonic() + timeout, stage_deadline)
+
+def _deadline_passed(deadline):
+    timeout = time_left(deadline)
+    return timeout is not None and timeout <= 0
+
+def _remaining_seconds(deadline):
+    timeout = time_left(deadline)
+    return None if timeout is None else max(0.0, timeout)
+
+# Waits for a slot of the model, then runs the call on _complete_executor so it can be given up
+# on at the deadline. The slot is held until the call has really returned.
+def _governed_call(model_name, deadline, fn, *args):
+    governor.acquire(model_name, deadline)
+
+    def run():
+        try:
+            return fn(*args)
+        finally:
+            governor.release(model_name)
+
+    return submit(_complete_executor, run).result(timeout=_remaining_seconds(deadline))
+
+# Filled in by routed_complete with the model that actually answered, which may be a fallback
+# model. For a stream it is known once the first chunk has arrived.
+class Routing:
+    def __init__(self):
+        self.model_name = None
+
+# Runs Cortex Complete for a stage ("rewrite", "complete", "summary" or "memory") on the model
+# routed to it. Throttled calls are retried on the same model with backoff (see
+# governor.CallGovernor.retry); on timeout, persistent throttling or a busy model it falls back
+# to the next model until the stage's deadline. Every model tried is a tracing span.
+def routed_complete(stage, selected_model, prompt, session, stream=False, routing=None):
+    models = route(stage, selected_model)
+    routing = routing or Routing()
+    stage_deadline = None
+    if stage in STAGE_DEADLINE_SECONDS:
+        stage_deadline = time.monotonic() + STAGE_DEADLINE_SECONDS[stage]
+    if stream:
+        return _stream_with_fallback(stage, models, prompt, session, stage_deadline, routing)
+
+    for index, model_name in enumerate(models):
+        with tracer.span(stage, model_name, prompt) as span:
+            deadline = _attempt_deadline(stage, stage_deadline)
+            try:
+                response = governor.retry(
+                    model_name, lambda: _governed_call(model_name, deadline, complete, model_name, prompt, session),
+                    deadline
+                )
+            except Exception as e:
+                if index == len(models) - 1 or not should_fall_back(e) or _deadline_passed(stage_deadline):
+                    raise
+                span.error = type(e).__name__
+                logger.warning(f"{model_name} failed for {stage}, falling back to {models[index + 1]}: {e}")
+                continue
+            span.set_response(response)
+            routing.model_name = model_name
+            return response
+
+# Closes a stream that was given up on and gives its slot back
+def _abandon_stream(model_name, chunks):
+    try:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    finally:
+        governor.release(model_name)
+
+# Opens a stream in a slot of the model and waits for its first chunk until the deadline.
+# On success the caller owns the slot and releases it once the stream is done. If the first
+# chunk is late, the slot is only given back once the pending read has really returned.
+def _open_stream(model_name, prompt, session, deadline):
+    governor.acquire(model_name, deadline)
+    try:
+        chunks = iter(complete(model_name, prompt, session, stream=True))
+    except BaseException:
+        governor.release(model_name)
+        raise
+    first_read = submit(_complete_executor, next, chunks, None)
+    try:
+        return first_read.result(timeout=_remaining_seconds(deadline)), chunks
+    except BaseException:
+        first_read.add_done_callback(lambda _: _abandon_stream(model_name, chunks))
+        raise
+
+# Streaming variant: a model is only retried or given up on if its first chunk does not arrive
+# in time. Once the answer has started streaming it is not switched to another model.
+def _stream_with_fallback(stage, models, prompt, session, stage_deadline, routing):
+    for index, model_name in enumerate(models):
+        with tracer.span(stage, model_name, prompt) as span:
+            deadline = _attempt_deadline(stage, stage_deadline)
+            try:
+                first_chunk, chunks = governor.retry(
+                    model_name, lambda: _open_stream(model_name, prompt, session, deadline), deadline
+                )
+            except Exception as e:
+                if index == len(models) - 1 or not should_fall_back(e) or _deadline_passed(stage_deadline):
+                    raise
+                span.error = type(e).__name__
+                logger.warning(f"{model_name} failed for {stage}, falling back to {models[index + 1]}: {e}")
+                continue
+
+            routing.model_name = model_name
+            response_size = 0
+            try:
+                if first_chunk is not None:
+                    for chunk in itertools.chain([first_chunk], chunks):
+                        response_size += len(chunk)
+                        yield chunk
+            finally:
+                governor.release(model_name)
+            span.response_size = response_size
+            return
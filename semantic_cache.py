@@ -0,0 +1,128 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from tracing import tracer
+
+
+# Cortex embedding model used for questions; its vectors have EMBEDDING_DIMENSIONS entries
+EMBEDDING_MODEL = 'snowflake-arctic-embed-m'
+EMBEDDING_DIMENSIONS = 768
+
+# A cached answer is reused for a new question whose embedding has at least this cosine
+# similarity with the cached question
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHE_MAX_ENTRIES = 2048
+
+logger = logging.getLogger(__name__)
+
+
+# Embeds a question with Cortex. Returns a unit-length float32 vector, or None if the
+# embedding could not be computed, in which case the caller just skips the semantic cache.
+def embed_question(session, question):
+    try:
+        with tracer.span("embed", EMBEDDING_MODEL, question) as span:
+            row = session.sql(
+                "SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768(?, ?) AS embedding", (EMBEDDING_MODEL, question)
+            ).collect()[0]
+            embedding = row['EMBEDDING']
+            # Depending on the connector version VECTOR values arrive as lists or JSON text
+            if isinstance(embedding, str):
+                embedding = json.loads(embedding)
+            span.set_response(embedding)
+    except Exception as e:
+        logger.warning(f"Could not embed question: {e}")
+        return None
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+# Answers of recent questions, found by embedding similarity instead of an exact key, so
+# rephrasings of a question reuse its answer. Question embeddings are rows of one bounded
+# matrix and a lookup is a single matrix-vector product. Each entry belongs to a scope (model,
+# category filter and index version) and only matches questions asked in the same scope. When
+# the matrix is full the least recently used entry is replaced.
+class SemanticCache:
+    def __init__(self, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, dimensions=EMBEDDING_DIMENSIONS,
+                 threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._embeddings = np.zeros((max_entries, dimensions), dtype=np.float32)
+        # Scope ID of every row, -1 for unused rows
+        self._row_scopes = np.full(max_entries, -1, dtype=np.int64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._entries = [None] * max_entries
+        self._scope_ids = {}
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    # A new scope forgets the scopes no row belongs to any more and takes the lowest free ID,
+    # so there are never more scopes or IDs than rows
+    def _scope_id(self, scope):
+        scope_id = self._scope_ids.get(scope)
+        if scope_id is None:
+            live = set(self._row_scopes[self._row_scopes != -1].tolist())
+            self._scope_ids = {known: known_id for known, known_id in self._scope_ids.items() if known_id in live}
+            scope_id = next(candidate for candidate in itertools.count() if candidate not in live)
+            self._scope_ids[scope] = scope_id
+        return scope_id
+
+    # Returns the entry of the most similar cached question in the scope, or None if no
+    # cached question reaches the threshold
+    def get(self, embedding, scope):
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is not None:
+                # Rows are unit length, so their dot products are the cosine similarities
+                similarities = self._embeddings @ embedding
+                similarities[self._row_scopes != scope_id] = -1.0
+                row = int(np.argmax(similarities))
+                if similarities[row] >= self.threshold:
+                    self._hits += 1
+                    self._last_used[row] = time.monotonic()
+                    return self._entries[row]
+            self._misses += 1
+            return None
+
+    def put(self, embedding, scope, entry):
+        with self._lock:
+            scope_id = self._scope_id(scope)
+            in_scope = np.flatnonzero(self._row_scopes == scope_id)
+            # A question that is already cached only has its entry refreshed
+            if len(in_scope) and float(np.max(self._embeddings[in_scope] @ embedding)) >= 0.999:
+                row = int(in_scope[np.argmax(self._embeddings[in_scope] @ embedding)])
+            else:
+                unused = np.flatnonzero(self._row_scopes == -1)
+                row = int(unused[0]) if len(unused) else int(np.argmin(self._last_used))
+            self._embeddings[row] = embedding
+            self._row_scopes[row] = scope_id
+            self._last_used[row] = time.monotonic()
+            self._entries[row] = entry
+
+    def clear(self):
+        with self._lock:
+            self._row_scopes[:] = -1
+            self._entries = [None] * self.max_entries
+            self._scope_ids = {}
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "size": int(np.count_nonzero(self._row_scopes != -1)),
+            }
+
+
+semantic_cache = SemanticCache()
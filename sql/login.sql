@@ -7,8 +7,56 @@ CREATE TABLE IF NOT EXISTS users (
     password_hash STRING NOT NULL
 );
 
+-- Bumped on logout, which revokes every session token issued to the user before (see auth.py)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER;
+
 CREATE TABLE IF NOT EXISTS user_prompts (
     id INTEGER AUTOINCREMENT PRIMARY KEY,
     user_id INTEGER REFERENCES users(id),
     prompt_text STRING NOT NULL
 );
+
+ALTER TABLE user_prompts ADD COLUMN IF NOT EXISTS answer STRING;
+ALTER TABLE user_prompts ADD COLUMN IF NOT EXISTS model_name STRING;
+ALTER TABLE user_prompts ADD COLUMN IF NOT EXISTS latency_ms NUMBER;
+-- Set in UTC by prompt_log.PromptLogWriter for every record it inserts
+ALTER TABLE user_prompts ADD COLUMN IF NOT EXISTS created_at TIMESTAMP_NTZ;
+
+CREATE TABLE IF NOT EXISTS answer_cache (
+    cache_key STRING PRIMARY KEY,
+    model_name STRING NOT NULL,
+    question STRING NOT NULL,
+    answer STRING NOT NULL,
+    summary STRING,
+    index_version STRING,
+    created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+);
+
+-- Snowflake standard tables have no secondary indexes; clustering on (user_id, id) keeps
+-- each user's turns together so history pages and point reads prune to few micro-partitions
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    id INTEGER AUTOINCREMENT PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    question STRING NOT NULL,
+    answer STRING NOT NULL,
+    summary STRING,
+    chunk_ids VARIANT,
+    model_name STRING,
+    created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+)
+CLUSTER BY (user_id, id);
+
+-- One row per tracing span (see tracing.py); spans of one chat turn share a trace_id
+CREATE TABLE IF NOT EXISTS pipeline_metrics (
+    id INTEGER AUTOINCREMENT PRIMARY KEY,
+    trace_id STRING,
+    stage STRING NOT NULL,
+    model_name STRING,
+    detail STRING,
+    duration_ms FLOAT NOT NULL,
+    prompt_size INTEGER,
+    response_size INTEGER,
+    error STRING,
+    started_at TIMESTAMP_NTZ,
+    created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+);
@@ -3,57 +3,115 @@ USE DATABASE CC_QUICKSTART_CORTEX_SEARCH_DOCS;
 USE SCHEMA DATA;
 
 -- Creating a PDF text chunker function
+-- Pages are read and split one at a time, so memory stays bounded by roughly one page plus
+-- one chunk. The last chunk of each page is carried over and re-split together with the next
+-- page, so chunks still flow across page breaks. A page that fails to extract is skipped
+-- instead of discarding the whole document. Every chunk comes with the page it starts on
+-- and its character offset within the document text.
 CREATE OR REPLACE FUNCTION pdf_text_chunker(file_url STRING)
-RETURNS TABLE (chunk VARCHAR)
+RETURNS TABLE (chunk VARCHAR, page_number NUMBER, chunk_offset NUMBER)
 LANGUAGE PYTHON
 RUNTIME_VERSION = '3.9'
 HANDLER = 'pdf_text_chunker'
 PACKAGES = ('snowflake-snowpark-python', 'PyPDF2', 'langchain')
 AS
 $$
-from snowflake.snowpark.types import StringType, StructField, StructType
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from snowflake.snowpark.files import SnowflakeFile
-import PyPDF2, io
+import PyPDF2
 import logging
-import pandas as pd
 
 from PyPDF2.errors import PdfReadError
 
+CHUNK_SIZE = 1512
+CHUNK_OVERLAP = 256
+
+logger = logging.getLogger("udf_logger")
+
 class pdf_text_chunker:
-    def read_pdf(self, file_url: str) -> str:
-        logger = logging.getLogger("udf_logger")
+    def __init__(self):
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size = CHUNK_SIZE, chunk_overlap = CHUNK_OVERLAP, length_function = len
+        )
+
+    # Yields (page_number, text) for every page that could be extracted
+    def read_pages(self, file_url: str):
         logger.info(f"Opening file {file_url}")
-        
         try:
             with SnowflakeFile.open(file_url, 'rb') as f:
-                buffer = io.BytesIO(f.readall())
-            reader = PyPDF2.PdfReader(buffer)
-            text = ""
-            for page in reader.pages:
-                try:
-                    text += page.extract_text().replace('\n', ' ').replace('\0', ' ')
-                except Exception as e:
-                    logger.warn(f"Unable to extract text from file {file_url}, page {page}: {e}")
-                    text = "Unable to Extract"
+                reader = PyPDF2.PdfReader(f)
+                for page_number, page in enumerate(reader.pages, start=1):
+                    try:
+                        text = page.extract_text() or ""
+                    except Exception as e:
+                        logger.warning(f"Unable to extract text from file {file_url}, page {page_number}: {e}")
+                        continue
+                    text = text.replace('\n', ' ').replace('\0', ' ').strip()
+                    if text:
+                        yield page_number, text
         except PdfReadError as e:
             logger.error(f"Failed to read PDF file {file_url}: {e}")
-            text = "PDF Read Error"
         except Exception as e:
             logger.error(f"Unexpected error while reading PDF file {file_url}: {e}")
-            text = "General Error"
-        
-        return text
-
 
     def process(self, file_url: str):
-        text = self.read_pdf(file_url)
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size = 1512, chunk_overlap  = 256, length_function = len
-        )
-        chunks = text_splitter.split_text(text)
-        df = pd.DataFrame(chunks, columns=['chunks'])
-        yield from df.itertuples(index=False, name=None)
+        buffer = ""
+        buffer_offset = 0   # document offset of buffer[0]
+        page_starts = []    # (position in buffer, page number) for pages present in the buffer
+
+        for page_number, text in self.read_pages(file_url):
+            if buffer:
+                buffer += " "
+            page_starts.append((len(buffer), page_number))
+            buffer += text
+
+            chunks = self.text_splitter.split_text(buffer)
+            cursor = 0
+            positions = []
+            for chunk in chunks:
+                start = buffer.find(chunk, cursor)
+                if start < 0:
+                    start = cursor
+                positions.append(start)
+                cursor = start + 1
+
+            # Everything but the last chunk is final; the last one may continue on the next page
+            for chunk, start in zip(chunks[:-1], positions[:-1]):
+                yield (chunk, self.page_at(page_starts, start), buffer_offset + start)
+
+            if not chunks:
+                continue
+            carry_start = positions[-1]
+            buffer = buffer[carry_start:]
+            buffer_offset += carry_start
+            page_starts = self.shift_page_starts(page_starts, carry_start)
+
+        if buffer:
+            for chunk in self.text_splitter.split_text(buffer):
+                start = max(buffer.find(chunk), 0)
+                yield (chunk, self.page_at(page_starts, start), buffer_offset + start)
+
+    @staticmethod
+    def page_at(page_starts, position):
+        page_number = page_starts[0][1]
+        for start, number in page_starts:
+            if start > position:
+                break
+            page_number = number
+        return page_number
+
+    # Moves page boundaries after the buffer lost its first `removed` characters, keeping
+    # the page that the new buffer starts in
+    @staticmethod
+    def shift_page_starts(page_starts, removed):
+        shifted = []
+        for start, number in page_starts:
+            start -= removed
+            if start <= 0:
+                shifted = [(0, number)]
+            else:
+                shifted.append((start, number))
+        return shifted
 $$;
 
 -- Creating a stage for documents
@@ -68,30 +126,137 @@ CREATE TABLE IF NOT EXISTS DOCS_CHUNKS_TABLE (
     FILE_URL VARCHAR(16777216),
     SCOPED_FILE_URL VARCHAR(16777216),
     CHUNK VARCHAR(16777216),
+    PAGE_NUMBER NUMBER(38,0),
+    CHUNK_OFFSET NUMBER(38,0),
     CATEGORY VARCHAR(16777216)
 );
 
--- Categorizing documents
-CREATE OR REPLACE TEMPORARY TABLE docs_categories AS WITH unique_documents AS (
-  SELECT DISTINCT relative_path FROM DOCS_CHUNKS_TABLE
-),
-docs_category_cte AS (
-  SELECT relative_path,
-    TRIM(snowflake.cortex.COMPLETE (
-      'llama3-70b',
-      'Given the name of the file between <file> and </file> determine if it is related to bikes or snow or gdp or equity or income or sales. Use only one word <file> ' || relative_path || '</file>'
-    ), '\n') AS category
-  FROM unique_documents
-)
-SELECT * FROM docs_category_cte;
-
-UPDATE docs_chunks_table 
-SET category = docs_categories.category
-FROM docs_categories
-WHERE docs_chunks_table.relative_path = docs_categories.relative_path;
-
--- Creating the Cortex Search Service
-CREATE OR REPLACE CORTEX SEARCH SERVICE CC_SEARCH_SERVICE_CS
+-- Tables created before the chunker reported page numbers and offsets
+ALTER TABLE DOCS_CHUNKS_TABLE ADD COLUMN IF NOT EXISTS PAGE_NUMBER NUMBER(38,0);
+ALTER TABLE DOCS_CHUNKS_TABLE ADD COLUMN IF NOT EXISTS CHUNK_OFFSET NUMBER(38,0);
+
+-- Stream over the stage's directory table. It records every file added to, replaced on or
+-- removed from the docs stage since the last ingestion run. A replaced file shows up as a
+-- DELETE plus an INSERT. Internal stages do not refresh their directory table on their own,
+-- so run ALTER STAGE docs REFRESH after uploading files.
+CREATE STREAM IF NOT EXISTS docs_stream ON STAGE docs;
+
+-- Incrementally ingests the files recorded in docs_stream:
+--   1. chunks of deleted or replaced files are removed
+--   2. new or replaced files are chunked
+--   3. only those files are categorized, with one COMPLETE call per batch of file names
+-- DOCS_CHUNKS_TABLE is updated in place, so the search service picks the changes up within
+-- its TARGET_LAG and never has to be rebuilt.
+-- The stream is read and DOCS_CHUNKS_TABLE is changed in one transaction. If any step fails,
+-- everything is rolled back, the stream offset stays where it was and the next run retries
+-- the same changes.
+CREATE OR REPLACE PROCEDURE ingest_docs()
+RETURNS STRING
+LANGUAGE SQL
+AS
+$$
+DECLARE
+    new_files INTEGER DEFAULT 0;
+    removed_files INTEGER DEFAULT 0;
+BEGIN
+    CREATE TEMPORARY TABLE IF NOT EXISTS docs_changes (
+        relative_path VARCHAR,
+        size NUMBER(38,0),
+        file_url VARCHAR,
+        action VARCHAR
+    );
+    TRUNCATE TABLE docs_changes;
+
+    -- Reading the stream in a DML statement advances its offset, but only once the
+    -- transaction commits after the last step below
+    BEGIN TRANSACTION;
+    INSERT INTO docs_changes
+        SELECT relative_path, size, file_url, METADATA$ACTION
+        FROM docs_stream;
+
+    SELECT COUNT(DISTINCT relative_path) INTO :removed_files FROM docs_changes WHERE action = 'DELETE';
+    SELECT COUNT(DISTINCT relative_path) INTO :new_files FROM docs_changes WHERE action = 'INSERT';
+
+    DELETE FROM DOCS_CHUNKS_TABLE
+    WHERE relative_path IN (SELECT relative_path FROM docs_changes);
+
+    INSERT INTO DOCS_CHUNKS_TABLE (relative_path, size, file_url, scoped_file_url, chunk, page_number, chunk_offset)
+        SELECT changes.relative_path,
+               changes.size,
+               changes.file_url,
+               build_scoped_file_url(@docs, changes.relative_path),
+               func.chunk,
+               func.page_number,
+               func.chunk_offset
+        FROM docs_changes changes,
+             TABLE(pdf_text_chunker(build_scoped_file_url(@docs, changes.relative_path))) AS func
+        WHERE changes.action = 'INSERT';
+
+    -- Categorize the new files in batches of 50 names per COMPLETE call
+    UPDATE DOCS_CHUNKS_TABLE
+    SET category = categories.category
+    FROM (
+        WITH new_documents AS (
+            SELECT DISTINCT relative_path FROM docs_changes WHERE action = 'INSERT'
+        ),
+        batches AS (
+            SELECT CEIL(ROW_NUMBER() OVER (ORDER BY relative_path) / 50) AS batch_id, relative_path
+            FROM new_documents
+        ),
+        responses AS (
+            SELECT TRY_PARSE_JSON(snowflake.cortex.COMPLETE(
+                'llama3-70b',
+                'For each file name between <files> and </files> (one per line) determine if it is related to bikes or snow or gdp or equity or income or sales. '
+                || 'Answer only with a JSON object that maps every file name to one word. <files>'
+                || LISTAGG(relative_path, '\n') WITHIN GROUP (ORDER BY relative_path) || '</files>'
+            )) AS answer
+            FROM batches
+            GROUP BY batch_id
+        )
+        SELECT file.key AS relative_path, TRIM(file.value::STRING) AS category
+        FROM responses, LATERAL FLATTEN(input => responses.answer) file
+    ) categories
+    WHERE DOCS_CHUNKS_TABLE.relative_path = categories.relative_path;
+
+    -- Files the batched answer missed (e.g. it was not valid JSON) are categorized one by one
+    UPDATE DOCS_CHUNKS_TABLE
+    SET category = categories.category
+    FROM (
+        SELECT relative_path,
+            TRIM(snowflake.cortex.COMPLETE (
+              'llama3-70b',
+              'Given the name of the file between <file> and </file> determine if it is related to bikes or snow or gdp or equity or income or sales. Use only one word <file> ' || relative_path || '</file>'
+            ), '\n') AS category
+        FROM (
+            SELECT DISTINCT relative_path FROM DOCS_CHUNKS_TABLE
+            WHERE category IS NULL
+              AND relative_path IN (SELECT relative_path FROM docs_changes WHERE action = 'INSERT')
+        )
+    ) categories
+    WHERE DOCS_CHUNKS_TABLE.relative_path = categories.relative_path;
+
+    COMMIT;
+    RETURN 'Ingested ' || new_files || ' file(s), removed ' || removed_files || ' file(s)';
+EXCEPTION
+    WHEN OTHER THEN
+        ROLLBACK;
+        RAISE;
+END;
+$$;
+
+-- Runs the ingestion every minute, but only when the stream has recorded changes
+CREATE OR REPLACE TASK ingest_docs_task
+WAREHOUSE = COMPUTE_WH
+SCHEDULE = '1 minute'
+WHEN SYSTEM$STREAM_HAS_DATA('docs_stream')
+AS
+    CALL ingest_docs();
+
+ALTER TASK ingest_docs_task RESUME;
+
+-- Creating the Cortex Search Service. It is only created once; afterwards it refreshes from
+-- DOCS_CHUNKS_TABLE under its TARGET_LAG as ingest_docs updates the table.
+CREATE CORTEX SEARCH SERVICE IF NOT EXISTS CC_SEARCH_SERVICE_CS
 ON chunk
 ATTRIBUTES category
 WAREHOUSE = COMPUTE_WH
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+import governor as governor_module
+from governor import CallGovernor, DeadlineExceededError, ServiceBusyError
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.001)
+
+
+def queue_call(governor, key, order, name, deadline=None):
+    def call():
+        governor.acquire(key, deadline)
+        order.append(name)
+        governor.release(key)
+
+    thread = threading.Thread(target=call)
+    waiting = governor.stats().get(key, {}).get("waiting", 0)
+    thread.start()
+    wait_until(lambda: governor.stats()[key]["waiting"] == waiting + 1)
+    return thread
+
+
+def test_released_slots_are_handed_over_in_fifo_order():
+    governor = CallGovernor(limits={"m": 1})
+    governor.acquire("m")
+    order = []
+    threads = [queue_call(governor, "m", order, name) for name in range(5)]
+
+    governor.release("m")
+    for thread in threads:
+        thread.join(2)
+
+    assert order == [0, 1, 2, 3, 4]
+    assert governor.stats()["m"]["in_flight"] == 0
+    assert governor.stats()["m"]["queued"] == 5
+
+
+def test_queued_call_gives_up_at_its_deadline():
+    governor = CallGovernor(limits={"m": 1})
+    governor.acquire("m")
+
+    started_at = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        governor.acquire("m", time.monotonic() + 0.1)
+    assert 0.09 <= time.monotonic() - started_at < 1.0
+
+    stats = governor.stats()["m"]
+    assert (stats["waiting"], stats["timed_out"], stats["in_flight"]) == (0, 1, 1)
+    governor.release("m")
+    assert governor.stats()["m"]["in_flight"] == 0
+
+
+def test_calls_beyond_the_queue_depth_are_shed():
+    governor = CallGovernor(limits={"m": 1}, max_queue_depth=1)
+    governor.acquire("m")
+    order = []
+    thread = queue_call(governor, "m", order, "queued")
+
+    with pytest.raises(ServiceBusyError):
+        governor.acquire("m", time.monotonic() + 5)
+    assert governor.stats()["m"]["shed"] == 1
+
+    governor.release("m")
+    thread.join(2)
+    assert order == ["queued"]
+
+
+# The slot is handed over just as the waiter's wait times out: the waiter has to keep the slot
+# instead of dropping out of the queue, or the slot leaks
+def test_slot_handed_over_as_the_wait_times_out_is_kept(monkeypatch):
+    class LateEvent(threading.Event):
+        def wait(self, timeout=None):
+            super().wait(timeout)
+            return False
+
+    governor = CallGovernor(limits={"m": 1})
+    governor.acquire("m")
+    acquired = threading.Event()
+    done = threading.Event()
+
+    def call():
+        governor.acquire("m", time.monotonic() + 5)
+        acquired.set()
+        done.wait(2)
+        governor.release("m")
+
+    thread = threading.Thread(target=call)
+    monkeypatch.setattr(governor_module.threading, "Event", LateEvent)
+    thread.start()
+    wait_until(lambda: governor.stats()["m"]["waiting"] == 1)
+    monkeypatch.undo()
+
+    governor.release("m")
+    assert acquired.wait(2)
+    stats = governor.stats()["m"]
+    assert (stats["in_flight"], stats["waiting"], stats["timed_out"]) == (1, 0, 0)
+    done.set()
+    thread.join(2)
+    assert governor.stats()["m"]["in_flight"] == 0
+
+
+def test_throttled_calls_are_retried_and_other_errors_are_not():
+    governor = CallGovernor(limits={"m": 1}, backoff_base=0.001, backoff_max=0.001, seed=1)
+    attempts = []
+
+    def throttled_twice():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("429 Too Many Requests")
+        return "answer"
+
+    assert governor.call("m", None, throttled_twice) == "answer"
+    assert governor.stats()["m"]["retries"] == 2
+    assert governor.stats()["m"]["in_flight"] == 0
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("bad prompt")
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        governor.call("m", None, broken)
+    assert len(attempts) == 1
+
+
+def test_throttling_outlasting_the_retries_is_raised():
+    governor = CallGovernor(limits={"m": 1}, max_retries=2, backoff_base=0.001, backoff_max=0.001)
+
+    def throttled():
+        raise RuntimeError("model is overloaded")
+
+    with pytest.raises(RuntimeError):
+        governor.call("m", None, throttled)
+    assert governor.stats()["m"]["retries"] == 2
@@ -0,0 +1,25 @@
+import pytest
+
+from pipeline import ResponseCleaner, clean_response
+
+
+def split_into(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 1000])
+def test_streamed_answer_is_cleaned_like_the_whole_answer(size):
+    text = "Revenue was 3,515million in 2023 and 12thousand units, up from 2billion."
+    assert "".join(ResponseCleaner().filter(split_into(text, size))) == clean_response(text)
+
+
+def test_number_and_unit_split_across_chunks_are_spaced():
+    chunks = ["Net sales of 2", "7", "million", " rose"]
+    assert "".join(ResponseCleaner().filter(chunks)) == "Net sales of 27 million rose"
+
+
+def test_trailing_word_is_held_back_until_the_stream_ends():
+    cleaner = ResponseCleaner()
+    assert cleaner.feed("Sales of 3") == "Sales of "
+    assert cleaner.feed("million") == ""
+    assert cleaner.flush() == "3 million"
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("bcrypt")
+
+import auth
+from auth import create_session_token, verify_session_token
+
+
+@pytest.fixture(autouse=True)
+def token_secret(monkeypatch):
+    monkeypatch.setenv(auth.TOKEN_SECRET_ENV_VAR, "test-secret")
+    monkeypatch.setattr(auth, "_token_secret", None)
+
+
+def test_token_round_trip():
+    token = create_session_token(7, "analyst", token_version=3)
+    assert verify_session_token(token) == (7, "analyst", 3)
+
+
+def test_expired_token_is_rejected():
+    token = create_session_token(7, "analyst", ttl_seconds=-1)
+    assert verify_session_token(token) is None
+
+
+def test_tampered_token_is_rejected():
+    payload, signature = create_session_token(7, "analyst").split(".")
+    forged_payload = create_session_token(1, "admin").split(".")[0]
+    assert verify_session_token(f"{forged_payload}.{signature}") is None
+    assert verify_session_token(f"{payload}.{signature[:-2]}xx") is None
+
+
+def test_token_signed_with_another_secret_is_rejected(monkeypatch):
+    token = create_session_token(7, "analyst")
+    monkeypatch.setenv(auth.TOKEN_SECRET_ENV_VAR, "other-secret")
+    monkeypatch.setattr(auth, "_token_secret", None)
+    assert verify_session_token(token) is None
+
+
+@pytest.mark.parametrize("token", ["", "not-a-token", "a.b.c", "!!!.???"])
+def test_malformed_token_is_rejected(token):
+    assert verify_session_token(token) is None
+
+
+def test_token_expires_after_its_ttl(monkeypatch):
+    token = create_session_token(7, "analyst", ttl_seconds=60)
+    now = time.time()
+    monkeypatch.setattr(auth.time, "time", lambda: now + 61)
+    assert verify_session_token(token) is None
@@ -0,0 +1,207 @@
+import contextlib
+import contextvars
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+from batch_writer import BatchWriter
+
+
+# Durations kept per stage for the percentiles; older spans fall out of the window
+SPAN_WINDOW_SIZE = 1000
+# Most recent spans kept in memory for the per-turn breakdown in the diagnostics panel
+RECENT_SPANS = 500
+
+logger = logging.getLogger(__name__)
+
+# ID of the turn the current code runs for. Work handed to thread pools keeps it as long as it
+# is submitted through `submit` below.
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+# Nearest-rank percentile, e.g. percentile(durations, 0.95)
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+# Submits fn to an executor so that its spans are attributed to the caller's turn
+def submit(executor, fn, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# One timed step of a turn. Prompt and response sizes are the len() of what went in and came
+# back: characters for prompts and answers, items for search results and rows for SQL.
+class Span:
+    def __init__(self, stage, model_name=None, prompt=None, detail=None):
+        self.trace_id = _current_trace.get()
+        self.stage = stage
+        self.model_name = model_name
+        self.detail = detail
+        self.prompt_size = len(prompt) if prompt is not None else None
+        self.response_size = None
+        self.error = None
+        self.started_at = time.time()
+        self.duration_ms = None
+
+    def set_response(self, response):
+        self.response_size = len(response) if response is not None else None
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "model": self.model_name,
+            "detail": self.detail,
+            "duration_ms": round(self.duration_ms, 1),
+            "prompt_size": self.prompt_size,
+            "response_size": self.response_size,
+            "error": self.error,
+        }
+
+
+# Records spans, aggregates their durations into p50/p95 per stage and hands every span to
+# the metrics writer, if one is attached
+class Tracer:
+    def __init__(self, window_size=SPAN_WINDOW_SIZE, recent=RECENT_SPANS):
+        self.writer = None
+        self._durations = defaultdict(lambda: deque(maxlen=window_size))
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, model_name=None, prompt=None, detail=None):
+        span = Span(stage, model_name, prompt, detail)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration_ms = (time.perf_counter() - started_at) * 1000
+            self.record(span)
+
+    # Starts a new turn: every span recorded inside, including work submitted to thread pools
+    # with `submit`, carries the turn's trace ID. The turn itself is recorded as a span too.
+    @contextlib.contextmanager
+    def trace(self, stage, model_name=None, prompt=None):
+        token = _current_trace.set(uuid.uuid4().hex)
+        try:
+            with self.span(stage, model_name, prompt) as span:
+                yield span
+        finally:
+            _current_trace.reset(token)
+
+    def record(self, span):
+        with self._lock:
+            self._durations[span.stage].append(span.duration_ms)
+            self._recent.append(span)
+        if self.writer is not None:
+            self.writer.put(span)
+
+    # p50/p95 duration per stage over the recent window
+    def stats(self):
+        with self._lock:
+            durations = {stage: list(values) for stage, values in self._durations.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5), 1),
+                "p95_ms": round(percentile(values, 0.95), 1),
+            }
+            for stage, values in sorted(durations.items())
+        }
+
+    # Spans recorded for one turn, in the order they finished
+    def spans_for(self, trace_id):
+        with self._lock:
+            return [span for span in self._recent if span.trace_id == trace_id]
+
+    def recent_spans(self):
+        with self._lock:
+            return list(self._recent)
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._recent.clear()
+
+
+tracer = Tracer()
+
+
+# Short label for a SQL statement, e.g. "SELECT answer_cache" or "INSERT user_prompts"
+def statement_label(query):
+    words = query.split()
+    if not words:
+        return ""
+    verb = words[0].upper()
+    upper_words = [word.upper() for word in words]
+    for keyword in ("FROM", "INTO", "TABLE", "UPDATE"):
+        if keyword in upper_words[1:]:
+            index = upper_words.index(keyword, 1)
+            if index + 1 < len(words):
+                return f"{verb} {words[index + 1]}"
+    return verb
+
+
+class TracedQuery:
+    def __init__(self, query, statement, tracer):
+        self.query = query
+        self.statement = statement
+        self.tracer = tracer
+
+    def collect(self):
+        with self.tracer.span("sql", prompt=self.statement, detail=statement_label(self.statement)) as span:
+            rows = self.query.collect()
+            span.set_response(rows)
+            return rows
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+
+# Wraps a Snowpark session so that every session.sql(...).collect() is recorded as a "sql"
+# span. Everything else is passed through to the wrapped session.
+class TracedSession:
+    def __init__(self, session, tracer=tracer):
+        self.wrapped_session = session
+        self.tracer = tracer
+
+    def sql(self, query, params=None):
+        if params is None:
+            return TracedQuery(self.wrapped_session.sql(query), query, self.tracer)
+        return TracedQuery(self.wrapped_session.sql(query, params), query, self.tracer)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped_session, name)
+
+
+# The underlying session, for APIs that need a real Snowpark session (Root, Cortex Complete)
+def unwrap_session(session):
+    return getattr(session, "wrapped_session", session)
+
+
+# Writes spans to pipeline_metrics in batches. It writes through the unwrapped session, so
+# its own inserts are not traced.
+class MetricsWriter(BatchWriter):
+    def __init__(self, session_pool, **kwargs):
+        super().__init__(session_pool, thread_name="metrics-writer", **kwargs)
+
+    def _flush(self, batch):
+        placeholders = ", ".join(["(?, ?, ?, ?, ?, ?, ?, ?, TO_TIMESTAMP_NTZ(?))"] * len(batch))
+        params = []
+        for span in batch:
+            params += [span.trace_id, span.stage, span.model_name, span.detail, span.duration_ms,
+                       span.prompt_size, span.response_size, span.error, span.started_at]
+        try:
+            unwrap_session(self.session_pool.get()).sql(
+                "INSERT INTO pipeline_metrics (trace_id, stage, model_name, detail, duration_ms, "
+                f"prompt_size, response_size, error, started_at) VALUES {placeholders}",
+                params
+            ).collect()
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} pipeline metrics: {e}")
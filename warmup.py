@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ANSWER_CACHE_TTL_SECONDS, get_index_version
+from pipeline import generate_answer
+from retrieval import search_all
+
+
+# At most this many Cortex calls are made at once by the warm-up job
+WARMUP_MAX_WORKERS = 4
+
+# How often the job checks whether the document index changed and answers need refreshing
+WARMUP_REFRESH_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+
+# Pre-computes answers and summaries for the recommendation questions with every model so
+# that clicking a recommendation is served from the answer cache. Runs in a daemon thread:
+# once at startup, again whenever the index version changes and again before the warmed
+# answers reach ANSWER_CACHE_TTL_SECONDS and expire. Search service handles
+# are built with create_search_services(session) for the pooled session in use, and again
+# whenever the pool has replaced that session.
+class AnswerWarmer:
+    def __init__(self, session_pool, create_search_services, columns, num_candidates, num_chunks, questions,
+                 model_names, max_workers=WARMUP_MAX_WORKERS, refresh_seconds=WARMUP_REFRESH_SECONDS):
+        self.session_pool = session_pool
+        self.create_search_services = create_search_services
+        self._search_services = None
+        self._search_services_session = None
+        self.columns = columns
+        self.num_candidates = num_candidates
+        self.num_chunks = num_chunks
+        self.questions = list(questions)
+        self.model_names = list(model_names)
+        self.max_workers = max_workers
+        self.refresh_seconds = refresh_seconds
+        self.warmed = False
+        self.warmed_version = None
+        self.warmed_at = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="answer-warmer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def search_services(self, session):
+        if session is not self._search_services_session:
+            self._search_services = self.create_search_services(session)
+            self._search_services_session = session
+        return self._search_services
+
+    def _run(self):
+        while not self._stop.is_set():
+            index_version = get_index_version(self.session_pool.get())
+            expiring = self.warmed and self._expiring()
+            if not self.warmed or index_version != self.warmed_version or expiring:
+                self.warmed_at = time.monotonic()
+                # Answers that are still cached have to be stored again to restart their TTL
+                self.warm_all(refresh=expiring)
+                self.warmed = True
+                self.warmed_version = index_version
+            self._stop.wait(self.refresh_seconds)
+
+    # Whether the warmed answers expire before the next check
+    def _expiring(self):
+        return time.monotonic() - self.warmed_at >= ANSWER_CACHE_TTL_SECONDS - self.refresh_seconds
+
+    # Retrieval is shared by every model asking the same question, so it runs once per
+    # question and the per-model completions are then queued on the bounded pool
+    def warm_all(self, refresh=False):
+        session = self.session_pool.get()
+        search_services = self.search_services(session)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="answer-warmer") as executor:
+            futures = []
+            for question in self.questions:
+                try:
+                    candidates = search_all(search_services, question, self.columns, self.num_candidates)
+                except Exception as e:
+                    logger.warning(f"Warm-up search failed for {question!r}: {e}")
+                    continue
+                for model_name in self.model_names:
+                    futures.append(executor.submit(
+                        generate_answer, session, model_name, question, candidates, self.num_chunks,
+                        refresh=refresh
+                    ))
+
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning(f"Warm-up completion failed: {e}")